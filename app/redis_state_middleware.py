@@ -0,0 +1,21 @@
+from django.conf import settings
+from radio.state import begin_request_state, end_request_state
+
+
+class RedisStateMiddleware(object):
+    """
+    Share one snapshot of the radio Redis state across a request.
+    With DEBUG or RADIO_DEBUG_HEADERS, the number of Redis round-trips is returned as X-Redis-Calls
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = begin_request_state()
+        try:
+            response = self.get_response(request)
+            if settings.DEBUG or getattr(settings, 'RADIO_DEBUG_HEADERS', False):
+                response['X-Redis-Calls'] = str(state.redis_calls)
+            return response
+        finally:
+            end_request_state()
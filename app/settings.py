@@ -76,6 +76,7 @@ MIDDLEWARE = [
     'app.remove_next_middleware.RemoveNextMiddleware',
     'app.json404_middleware.JSON404Middleware',
     'corsheaders.middleware.CorsMiddleware',
+    'app.redis_state_middleware.RedisStateMiddleware',
 ]
 
 ROOT_URLCONF = 'app.urls'
@@ -119,12 +120,24 @@ DATABASES = {
 
 
 # https://jupiny.com/2018/02/27/caching-using-redis-on-django/
+# One connection pool per process, shared by the radio state layer and the cache
+REDIS_POOL = {
+    "URL": "redis://{0}:{1}/{2}".format(
+        os.environ.get('REDIS_URL'), os.environ.get('REDIS_PORT'), os.environ.get('REDIS_DB')
+    ),
+    "MAX_CONNECTIONS": int(os.environ.get('REDIS_MAX_CONNECTIONS', 20)),
+    # Seconds to wait for a free connection when MAX_CONNECTIONS are in use
+    "POOL_TIMEOUT": float(os.environ.get('REDIS_POOL_TIMEOUT', 5)),
+    "SOCKET_TIMEOUT": float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5)),
+    "SOCKET_CONNECT_TIMEOUT": float(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 2)),
+}
+
+DJANGO_REDIS_CONNECTION_FACTORY = "radio.connection.SharedConnectionFactory"
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": "redis://{0}:{1}/{2}".format(
-            os.environ.get('REDIS_URL'), os.environ.get('REDIS_PORT'), os.environ.get('REDIS_DB')
-        ),
+        "LOCATION": REDIS_POOL["URL"],
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
@@ -388,7 +401,23 @@ from accounts.email_setup import *
 # Radio Setup #
 ###############
 
-MUSICDAEMON_URL = "http://10.0.0.3:9000"
+MUSICDAEMON_URL = os.environ.get('MUSICDAEMON_URL', "http://10.0.0.3:9000")
+# Send insert/move/remove deltas instead of the whole playlist. The daemon must speak the sync protocol of radio.daemon
+MUSICDAEMON_DELTA_SYNC = os.environ.get('MUSICDAEMON_DELTA_SYNC') == '1'
+
+# Next track selection per channel. "random" or "harmonic" (camelot key and BPM compatible)
+RADIO_SELECTION_MODE = {
+    "yui": "random",
+}
+
+# Server-Sent Events endpoint of run_push_gateway, e.g. "http://127.0.0.1:8091". Pages poll when empty
+PUSH_GATEWAY_URL = os.environ.get('PUSH_GATEWAY_URL', '')
+
+# Longest seconds a play waits in the buffer before flush_play_history inserts it into PlayHistory
+PLAY_HISTORY_FLUSH_DELAY = float(os.environ.get('PLAY_HISTORY_FLUSH_DELAY', 5))
+
+# Return X-Redis-Calls on every response. Always on with DEBUG
+RADIO_DEBUG_HEADERS = os.environ.get('RADIO_DEBUG_HEADERS') == '1'
 
 
 ##############
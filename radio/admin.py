@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.messages import ERROR
+from django.contrib.messages import ERROR, INFO, WARNING
+from django.contrib.postgres.fields import ArrayField
 from django.db.models import Q
 from django.http import HttpResponseRedirect
 from django.utils.html import format_html
@@ -13,14 +14,17 @@ from rest_framework.exceptions import ValidationError
 from rangefilter.filter import DateRangeFilter, DateTimeRangeFilter
 from admin_numeric_filter.admin import RangeNumericFilter
 from django.contrib.admin.filters import SimpleListFilter
-from .models import Track, PlayHistory, CHANNEL
+from django.contrib.admin.views.main import ChangeList
+from .models import Track, PlayHistory, CHANNEL, SERVICE_CHANNEL, get_channel_filter
 from .forms import UploadTrackForm, UpdateTrackForm
 from .util import (
-    get_redis_data, set_redis_data, delete_track, get_random_track,
-    get_is_pending_remove, get_pending_remove, set_pending_remove, NUM_SAMPLES
+    delete_track, get_random_track, get_playlist_entry, append_playlist, remove_playlist, replace_playlist,
+    get_is_pending_remove, are_pending_remove, add_pending_remove, cancel_pending_remove,
+    get_now_playing_ids, soft_delete_tracks, get_playlist_snapshot, NUM_SAMPLES
 )
 from .uploadhandler import ProgressBarUploadHandler
-from django_utils import api
+from .daemon import send_setlist, send_delta
+from .history import get_buffered_plays
 
 
 class ScaleFilter(InputFilter):
@@ -48,9 +52,11 @@ class ChannelFilter(admin.SimpleListFilter):
 
     def queryset(self, request, queryset):
         if self.value() is not None:
-            channel = [self.value()]
+            channel = self.value()
+            if isinstance(queryset.model._meta.get_field('channel'), ArrayField):
+                return queryset.filter(get_channel_filter(channel))
             return queryset.filter(
-                Q(channel__contains=channel)
+                Q(channel=channel)
             )
 
 
@@ -75,6 +81,17 @@ class PlayedFilter(SimpleListFilter):
         return queryset
 
 
+class PendingRemoveChangeList(ChangeList):
+    """
+    Answer pending remove of the whole page in one round-trip instead of per row per column
+    """
+    def get_results(self, request):
+        super().get_results(request)
+        pending_remove_ids = are_pending_remove([obj.pk for obj in self.result_list])
+        for obj in self.result_list:
+            obj.is_pending_remove = obj.pk in pending_remove_ids
+
+
 @admin.register(Track)
 class TrackAdmin(admin.ModelAdmin):
     change_list_template = "radio/track_list.html"
@@ -136,6 +153,7 @@ class TrackAdmin(admin.ModelAdmin):
         extra_context['editable'] = True
         extra_context['http_protocol'] = settings.HTTP_PROTOCOL
         extra_context['domain_url'] = settings.DOMAIN_URL
+        extra_context['push_url'] = settings.PUSH_GATEWAY_URL
         return super().changelist_view(request, extra_context=extra_context)
 
     def get_form(self, request, obj=None, **kwargs):
@@ -178,32 +196,22 @@ class TrackAdmin(admin.ModelAdmin):
         if get_is_pending_remove(track_id):
             self.message_user(request, 'You cannot queue-in because the track is reserved pending remove', level=ERROR)
         else:
-            redis_data = get_redis_data(channel)
-            if not redis_data:
+            if channel not in SERVICE_CHANNEL:
                 self.message_user(request, 'Channel does not exist', level=ERROR)
             else:
-                playlist = redis_data["playlist"]
-
                 track = Track.objects.get(id=track_id)
+                entry = get_playlist_entry(track)
 
-                new_track = {
-                    "id": track.id,
-                    "location": "/srv/media/%s" % track.location,
-                    "artist": track.artist,
-                    "title": track.title
-                }
+                previous_version = get_playlist_snapshot(channel)[0]
+                version, playlist = append_playlist(channel, entry)
 
-                playlist.append(new_track)
-                set_redis_data(channel, "playlist", playlist)
+                # append_playlist skips a track already queued and leaves the version as it was
+                if version == previous_version or not playlist or playlist[-1]["id"] != entry["id"]:
+                    self.message_user(request, 'The track is already queued', level=WARNING)
+                else:
+                    send_delta(channel, version, {"op": "insert", "index": len(playlist) - 1, "entry": entry})
 
-                api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data={
-                    "host": "server",
-                    "target": channel,
-                    "command": "setlist",
-                    "data": playlist
-                })
-
-                self.message_user(request, 'Success')
+                    self.message_user(request, 'Success')
 
         url = reverse(
             'admin:radio_track_changelist',
@@ -212,23 +220,17 @@ class TrackAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(url)
 
     def process_queueout(self, request, channel, index, *args, **kwargs):
-        redis_data = get_redis_data(channel)
-        if not redis_data:
+        if channel not in SERVICE_CHANNEL:
             self.message_user(request, 'Channel does not exist', level=ERROR)
         else:
-            playlist = redis_data["playlist"]
-
-            playlist.pop(int(index))
-
-            set_redis_data(channel, "playlist", playlist)
-            api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data={
-                "host": "server",
-                "target": channel,
-                "command": "setlist",
-                "data": playlist
-            })
+            try:
+                version, playlist = remove_playlist(channel, int(index))
+            except IndexError:
+                self.message_user(request, 'Invalid playlist index', level=ERROR)
+            else:
+                send_delta(channel, version, {"op": "remove", "index": int(index)})
 
-            self.message_user(request, 'Success')
+                self.message_user(request, 'Success')
 
         url = reverse(
             'admin:radio_track_changelist',
@@ -237,11 +239,11 @@ class TrackAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(url)
 
     def process_reset(self, request, channel, *args, **kwargs):
-        redis_data = get_redis_data(channel)
-        if not redis_data:
+        if channel not in SERVICE_CHANNEL:
             self.message_user(request, 'Channel does not exist', level=ERROR)
         else:
             random_tracks = get_random_track(channel, NUM_SAMPLES)
+            pending_remove_ids = are_pending_remove([track.id for track in random_tracks])
 
             response_daemon_data = []
             for track in random_tracks:
@@ -249,8 +251,7 @@ class TrackAdmin(admin.ModelAdmin):
                 artist = track.artist
                 title = track.title
 
-                is_pending_remove = get_is_pending_remove(track.id)
-                if not is_pending_remove:
+                if track.id not in pending_remove_ids:
                     response_daemon_data.append({
                         "id": track.id,
                         "location": "/srv/media/%s" % location,
@@ -258,14 +259,8 @@ class TrackAdmin(admin.ModelAdmin):
                         "title": title
                     })
 
-            response_daemon = {
-                "host": "server",
-                "target": channel,
-                "command": "setlist",
-                "data": response_daemon_data
-            }
-
-            api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data=response_daemon)
+            version, playlist = replace_playlist(channel, response_daemon_data)
+            send_setlist(channel, version, playlist)
 
             self.message_user(request, 'Success')
 
@@ -276,16 +271,7 @@ class TrackAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(url)
 
     def process_cancel_pending_delete(self, request, track_id, *args, **kwargs):
-        if get_is_pending_remove(int(track_id)):
-            pending_remove = get_pending_remove()
-            pending_remove_list = pending_remove["list"]
-            try:
-                index = pending_remove_list.index(int(track_id))
-            except ValueError:
-                self.message_user(request, 'Track is not pending remove', level=ERROR)
-            else:
-                pending_remove_list.pop(index)
-            set_pending_remove(pending_remove_list)
+        if cancel_pending_remove(int(track_id)):
             self.message_user(request, 'Success')
         else:
             self.message_user(request, 'Track is not pending remove', level=ERROR)
@@ -295,11 +281,21 @@ class TrackAdmin(admin.ModelAdmin):
         )
         return HttpResponseRedirect(url)
 
+    def get_changelist(self, request, **kwargs):
+        return PendingRemoveChangeList
+
+    def is_pending_remove(self, obj):
+        # Answered for the whole page by PendingRemoveChangeList
+        is_pending_remove = getattr(obj, 'is_pending_remove', None)
+        if is_pending_remove is None:
+            is_pending_remove = get_is_pending_remove(obj.pk)
+        return is_pending_remove
+
     def queue_in_playlist(self, obj):
         html = ''
         args = []
+        is_pending_remove = self.is_pending_remove(obj)
         for in_service_channel, in_service_channel_name in CHANNEL:
-            is_pending_remove = get_is_pending_remove(obj.pk)
             if not is_pending_remove:
                 html += '<a class="button" href="{}">%s</a>&nbsp;' % in_service_channel_name
                 args.append(
@@ -312,7 +308,7 @@ class TrackAdmin(admin.ModelAdmin):
     def pending_delete_cancel(self, obj):
         html = ''
         args = []
-        is_pending_remove = get_is_pending_remove(obj.pk)
+        is_pending_remove = self.is_pending_remove(obj)
         if is_pending_remove:
             html += '<a class="button" href="{}">Cancel</a>&nbsp;'
             args.append(
@@ -330,11 +326,18 @@ class TrackAdmin(admin.ModelAdmin):
         you can do anything here BEFORE deleting the object(s)
         """
 
-        try:
-            for track in queryset:
-                delete_track(track)
-        except ValidationError as e:
-            self.message_user(request, e.detail, level=ERROR)
+        # One UPDATE for the whole selection, purge_tracks deletes the files in the background
+        tracks = list(queryset)
+        playing_ids = get_now_playing_ids(SERVICE_CHANNEL)
+        reserved = [track for track in tracks if track.id in playing_ids]
+        for track in reserved:
+            add_pending_remove(track.id)
+        soft_delete_tracks([track for track in tracks if track.id not in playing_ids])
+
+        if reserved:
+            self.message_user(request, _("Pending remove reserved for %s beacuse current playing") % ", ".join(
+                "'%s'" % track for track in reserved
+            ), level=WARNING)
         else:
             self.message_user(request, "Success")
 
@@ -384,6 +387,16 @@ class PlayHistoryAdmin(admin.ModelAdmin):
     )
     ordering = ('-played_at',)
 
+    def changelist_view(self, request, extra_context=None):
+        buffered, waited = get_buffered_plays()
+        if buffered:
+            message = _("%(count)d recent plays are not listed yet, they appear within %(delay)d seconds") % {
+                "count": buffered,
+                "delay": max(settings.PLAY_HISTORY_FLUSH_DELAY - waited, 1),
+            }
+            self.message_user(request, message, INFO)
+        return super().changelist_view(request, extra_context=extra_context)
+
     def track_link(self, obj):
         track = Track.objects.get(id=obj.track.id)
         url = reverse("admin:radio_track_change", args=[track.id])
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class RadioConfig(AppConfig):
     name = 'radio'
+
+    def ready(self):
+        import radio.signals
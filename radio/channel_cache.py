@@ -0,0 +1,116 @@
+"""
+Per-process cache of the now playing and playlist of service channels.
+
+Entries are dropped by the channel events every write publishes, and expire after
+CHANNEL_CACHE_TTL seconds in case an event is missed, e.g. the music daemon writing Redis directly.
+Nothing is cached while the subscriber is not connected.
+"""
+import os
+import copy
+import json
+import time
+import threading
+from . import metrics
+
+
+CHANNEL_CACHE_TTL = 10
+
+_lock = threading.Lock()
+_entries = {}
+_generations = {}
+_listener_pid = None
+_subscribed = threading.Event()
+
+
+def invalidate_channel_cache(channel=None):
+    with _lock:
+        if channel is None:
+            _entries.clear()
+            for cached_channel in list(_generations.keys()):
+                _generations[cached_channel] += 1
+        else:
+            _entries.pop(channel, None)
+            _generations[channel] = _generations.get(channel, 0) + 1
+
+
+def _listen():
+    from .util import redis_server
+    from .scripts import CHANNEL_EVENTS
+
+    while True:
+        pubsub = redis_server.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL_EVENTS)
+            invalidate_channel_cache()
+            _subscribed.set()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    invalidate_channel_cache(json.loads(message["data"])["channel"])
+        except Exception as e:
+            print('redis pubsub error: {}'.format(e))
+            _subscribed.clear()
+            invalidate_channel_cache()
+            time.sleep(1)
+        finally:
+            pubsub.close()
+
+
+def _start_listener():
+    global _listener_pid
+
+    # A forked worker does not inherit the thread, so start one per process
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _lock:
+            if _listener_pid != pid:
+                _subscribed.clear()
+                threading.Thread(target=_listen, name="channel-cache", daemon=True).start()
+                _listener_pid = pid
+
+
+def get_cached_redis_data(channel):
+    """
+    get_redis_data served from process memory for service channels
+
+    :return: dict of "now_playing" and "playlist"
+    """
+    from .models import SERVICE_CHANNEL
+    from .util import fetch_redis_data
+
+    if channel not in SERVICE_CHANNEL:
+        return fetch_redis_data([channel])[0][channel]
+
+    _start_listener()
+    if not _subscribed.is_set():
+        metrics.incr("channel_cache.bypass")
+        return fetch_redis_data([channel])[0][channel]
+
+    with _lock:
+        entry = _entries.get(channel)
+        generation = _generations.get(channel, 0)
+    if entry is not None and entry[0] > time.monotonic():
+        metrics.incr("channel_cache.hit")
+        return copy.deepcopy(entry[1])
+
+    metrics.incr("channel_cache.miss")
+    redis_data = fetch_redis_data([channel])[0][channel]
+    with _lock:
+        # Do not store data fetched before an invalidation which arrived meanwhile
+        if _generations.get(channel, 0) == generation:
+            _entries[channel] = (time.monotonic() + CHANNEL_CACHE_TTL, redis_data)
+    return copy.deepcopy(redis_data)
+
+
+def get_cached_channel_version(channel):
+    """
+    Version of a cached channel without any round-trip. Falls back to a single GET
+    """
+    from .util import get_channel_version
+
+    if _subscribed.is_set():
+        with _lock:
+            entry = _entries.get(channel)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]["version"]
+    return get_channel_version(channel)
@@ -0,0 +1,76 @@
+"""
+Redis connection pool shared by the radio state layer and the Django cache.
+
+The pool is created on first use in each process and recreated after a fork,
+so uWSGI workers never share sockets with the master.
+"""
+import os
+import time
+import threading
+from django.conf import settings
+from django_redis.pool import ConnectionFactory
+from redis import BlockingConnectionPool
+from . import metrics
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class MeteredConnectionPool(BlockingConnectionPool):
+    """
+    Blocking pool which waits up to timeout seconds for a free connection instead of opening more than max_connections
+    """
+    def get_connection(self, *args, **kwargs):
+        started = time.perf_counter()
+        connection = super().get_connection(*args, **kwargs)
+        metrics.observe("redis.pool_wait", time.perf_counter() - started)
+        metrics.incr("redis.connections_in_use")
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        metrics.incr("redis.connections_in_use", -1)
+
+
+def get_connection_pool():
+    global _pool, _pool_pid
+
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                config = settings.REDIS_POOL
+                _pool = MeteredConnectionPool.from_url(
+                    config["URL"],
+                    max_connections=config["MAX_CONNECTIONS"],
+                    timeout=config["POOL_TIMEOUT"],
+                    socket_timeout=config["SOCKET_TIMEOUT"],
+                    socket_connect_timeout=config["SOCKET_CONNECT_TIMEOUT"],
+                )
+                _pool_pid = pid
+                metrics.reset_metrics("redis.connections_in_use")
+    return _pool
+
+
+class SharedConnectionPool(object):
+    """
+    Stand-in handed to clients created at import time. Resolves the process pool on every access
+    """
+    def __getattr__(self, name):
+        return getattr(get_connection_pool(), name)
+
+    def __repr__(self):
+        return "%s<%r>" % (self.__class__.__name__, get_connection_pool())
+
+
+shared_connection_pool = SharedConnectionPool()
+
+
+class SharedConnectionFactory(ConnectionFactory):
+    """
+    django_redis connection factory which hands out the shared pool. Set as DJANGO_REDIS_CONNECTION_FACTORY
+    """
+    def get_or_create_connection_pool(self, params):
+        return get_connection_pool()
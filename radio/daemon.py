@@ -0,0 +1,412 @@
+"""
+Commands to the music daemon.
+
+Requests append commands to a Redis Stream per channel, the outbox, and never wait for
+the daemon. An OutboxWorker runs on every replica and delivers the outboxes it holds the lease
+of, read through a consumer group under its own consumer name. It sends commands in order over
+a keep-alive aiohttp session, retries a failed one with backoff and acknowledges entries once
+delivered. Entries left unacknowledged, by a daemon which went away or a worker which died and
+whose lease another one took over, are sent again first, so delivery is at least once.
+
+Playlist sync protocol
+    setlist  data is the whole playlist, "version" its playlist version
+    delta    data is {"base": version the ops apply to, "version": version after them, "ops": [...]}
+             with ops {"op": "insert", "index", "entry"}, {"op": "move", "from", "to"} and {"op": "remove", "index"}
+The daemon answers {"status": "ok", "version": its version}, or "gap" when base is not its version,
+in which case the current playlist is sent as a setlist. A redelivered command is older than
+the daemon's version and answered ok. Commands read in one batch are merged, a setlist drops
+the commands of its channel queued before it.
+"""
+import json
+import time
+import asyncio
+from collections import OrderedDict
+import aiohttp
+from django.conf import settings
+from redis.exceptions import RedisError, ResponseError
+from . import metrics
+from .util import redis_server, get_playlist_snapshot
+from .lease import Lease, LEASE_RENEW_INTERVAL, get_consumer_name, claim_pending
+
+
+DAEMON_TIMEOUT = 5
+DAEMON_RETRY_LIMIT = 5
+DAEMON_BACKOFF = 0.5
+DAEMON_BACKOFF_MAX = 8
+# A longer delta costs the daemon more than the whole playlist
+DAEMON_COALESCE_MAX_OPS = 20
+
+# Playlist version of the on_startup, on_play and on_stop responses, so the daemon can follow the deltas after them
+PLAYLIST_VERSION_HEADER = "X-Playlist-Version"
+
+OUTBOX_KEY = "outbox:{}"
+OUTBOX_GROUP = "daemon"
+OUTBOX_STATS_KEY = "outbox:stats"
+# Entries beyond are trimmed even if not delivered, the daemon resyncs from the next gap
+OUTBOX_MAXLEN = 10000
+OUTBOX_BATCH = 100
+OUTBOX_BLOCK = 1000
+
+
+class DaemonError(Exception):
+    pass
+
+
+def apply_delta(playlist, op):
+    """
+    Apply one delta op to playlist in place, with the index semantics of the playlist scripts
+
+    :raise IndexError: index is out of range
+    """
+    length = len(playlist)
+    if op["op"] == "insert":
+        index = op["index"]
+        if index < -length or index > length:
+            raise IndexError(index)
+        playlist.insert(index if index >= 0 else index + length, op["entry"])
+    elif op["op"] == "move":
+        from_index, to_index = op["from"], op["to"]
+        if not (-length <= from_index < length and -length <= to_index < length):
+            raise IndexError(from_index)
+        entry = playlist.pop(from_index if from_index >= 0 else from_index + length)
+        playlist.insert(to_index if to_index >= 0 else to_index + length, entry)
+    elif op["op"] == "remove":
+        index = op["index"]
+        if not -length <= index < length:
+            raise IndexError(index)
+        playlist.pop(index)
+    else:
+        raise ValueError(op["op"])
+
+
+def coalesce(commands):
+    """
+    Merge consecutive deltas of a channel into one and drop what a later setlist of the channel replaces
+
+    :return: list of commands in sending order
+    """
+    merged = []
+    open_indexes = {}
+    for command in commands:
+        channel = command["target"]
+        if command["command"] == "setlist":
+            for index in open_indexes.pop(channel, []):
+                merged[index] = None
+            open_indexes[channel] = [len(merged)]
+            merged.append(command)
+        elif command["command"] == "delta":
+            indexes = open_indexes.setdefault(channel, [])
+            last = merged[indexes[-1]] if indexes else None
+            if last is not None and last["command"] == "delta" and last["data"]["version"] == command["data"]["base"]:
+                last["data"]["ops"] += command["data"]["ops"]
+                last["data"]["version"] = command["data"]["version"]
+            else:
+                indexes.append(len(merged))
+                # Copied since ops of following deltas are added to it
+                merged.append(dict(command, data=dict(command["data"], ops=list(command["data"]["ops"]))))
+        else:
+            open_indexes.pop(channel, None)
+            merged.append(command)
+    return [command for command in merged if command is not None]
+
+
+class DaemonClient(object):
+    def __init__(self, url, delta_sync=None):
+        self.url = url
+        self.delta_sync = settings.MUSICDAEMON_DELTA_SYNC if delta_sync is None else delta_sync
+
+    def session(self):
+        timeout = aiohttp.ClientTimeout(total=DAEMON_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=1, keepalive_timeout=60)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def get_setlist(self, loop, channel):
+        version, playlist = await loop.run_in_executor(None, get_playlist_snapshot, channel)
+        return build_daemon_command(channel, "setlist", playlist, version=version)
+
+    async def sync(self, loop, session, command):
+        """
+        Deliver command. A delta the daemon can not apply is followed by the current playlist
+
+        :return: the daemon response, None if it could not be delivered
+        """
+        if command["command"] != "delta":
+            return await self.deliver(session, command)
+
+        if not self.delta_sync or len(command["data"]["ops"]) > DAEMON_COALESCE_MAX_OPS:
+            return await self.deliver(session, await self.get_setlist(loop, command["target"]))
+
+        response = await self.deliver(session, command)
+        if isinstance(response, dict) and response.get("status") == "gap":
+            metrics.incr("daemon.gap")
+            response = await self.deliver(session, await self.get_setlist(loop, command["target"]))
+        return response
+
+    async def post(self, session, command):
+        """
+        :return: the decoded daemon response, {} if it is not JSON
+        :raise DaemonError: the daemon could not be reached or failed
+        """
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                self.url, data=json.dumps(command), headers={'content-type': 'application/json'}
+            ) as response:
+                body = await response.read()
+                if response.status >= 500:
+                    raise DaemonError("daemon answered %d" % response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DaemonError(repr(e))
+        metrics.observe("daemon.latency", time.perf_counter() - started)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {}
+
+    async def deliver(self, session, command):
+        """
+        Send command, retrying with exponential backoff. Later commands wait so the order is kept
+
+        :return: the daemon response, None if every attempt failed
+        """
+        delay = DAEMON_BACKOFF
+        for attempt in range(DAEMON_RETRY_LIMIT):
+            try:
+                response = await self.post(session, command)
+                metrics.incr("daemon.sent")
+                return response
+            except DaemonError as e:
+                metrics.incr("daemon.retry")
+                print('daemon error on {}: {}'.format(command["command"], e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DAEMON_BACKOFF_MAX)
+        metrics.incr("daemon.failed")
+        return None
+
+
+class OutboxWorker(object):
+    """
+    Delivers the outbox of channels in order. Every replica may run one, each outbox is delivered
+    by the holder of its lease only
+    """
+    def __init__(self, channels, client):
+        self.keys = {get_outbox_key(channel): channel for channel in channels}
+        self.client = client
+        self.consumer = get_consumer_name()
+        self.leases = {key: Lease(key, self.consumer) for key in self.keys}
+
+    def create_groups(self):
+        for key in self.keys:
+            try:
+                # From the start of the stream so commands added before the first worker are kept
+                redis_server.xgroup_create(key, OUTBOX_GROUP, id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    def hold_leases(self):
+        """
+        Renew or acquire the lease of every outbox, claiming what a previous holder left pending
+
+        :return: list of the outbox keys acquired by this call
+        """
+        acquired = []
+        for key, lease in self.leases.items():
+            try:
+                if lease.hold():
+                    claimed = claim_pending(key, OUTBOX_GROUP, self.consumer)
+                    print('outbox {} taken over by {}, {} entries claimed'.format(key, self.consumer, claimed))
+                    acquired.append(key)
+            except RedisError as e:
+                # Unsure whether another replica took over, stop until the lease is confirmed
+                lease.held = False
+                print('outbox lease error: {}'.format(e))
+        return acquired
+
+    def read(self, keys, replay):
+        """
+        :param keys: outbox keys to read
+        :param replay: read the entries delivered before but not acknowledged instead of new ones
+        :return: list of (stream key, entry id, command) in stream order per channel
+        """
+        streams = {key: '0' if replay else '>' for key in keys}
+        response = redis_server.xreadgroup(
+            OUTBOX_GROUP, self.consumer, streams, count=OUTBOX_BATCH, block=None if replay else OUTBOX_BLOCK
+        )
+        entries = []
+        for key, stream_entries in response or []:
+            key = key.decode('utf-8') if isinstance(key, bytes) else key
+            for entry_id, fields in stream_entries:
+                # Fields of an entry trimmed away while pending are empty
+                command = fields.get(b"command") if fields else None
+                entries.append((key, entry_id, json.loads(command) if command else None))
+        return entries
+
+    def run(self):
+        self.create_groups()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.work(loop))
+        finally:
+            for lease in self.leases.values():
+                try:
+                    lease.release()
+                except RedisError:
+                    pass
+
+    async def renew_leases(self, loop, acquired):
+        """
+        Keep the leases renewed while a slow delivery retries, adding the keys acquired to acquired
+        """
+        while True:
+            acquired.update(await loop.run_in_executor(None, self.hold_leases))
+            await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+    async def work(self, loop):
+        acquired = set()
+        renewal = loop.create_task(self.renew_leases(loop, acquired))
+        try:
+            async with self.client.session() as session:
+                # Whatever a previous run did not acknowledge goes first
+                replay = True
+                while True:
+                    keys = [key for key, lease in self.leases.items() if lease.held]
+                    if not keys:
+                        # Another replica delivers every outbox
+                        await asyncio.sleep(OUTBOX_BLOCK / 1000.0)
+                        continue
+                    if acquired:
+                        replay = True
+                        acquired.clear()
+
+                    try:
+                        entries = await loop.run_in_executor(None, self.read, keys, replay)
+                    except RedisError as e:
+                        print('outbox read error: {}'.format(e))
+                        await asyncio.sleep(DAEMON_BACKOFF_MAX)
+                        continue
+                    if replay and not entries:
+                        replay = False
+                        continue
+                    if replay:
+                        redis_server.hincrby(OUTBOX_STATS_KEY, "redelivered", len(entries))
+                        metrics.incr("outbox.redelivered", len(entries))
+
+                    if await self.deliver(loop, session, entries):
+                        metrics.incr("outbox.delivered", len(entries))
+                    else:
+                        # The daemon is away, send everything pending again once it answers
+                        replay = True
+                        await asyncio.sleep(DAEMON_BACKOFF_MAX)
+        finally:
+            renewal.cancel()
+
+    async def deliver(self, loop, session, entries):
+        """
+        Send entries and acknowledge those of each channel once all of them were delivered
+
+        :return: False if the daemon could not be reached
+        """
+        by_key = OrderedDict()
+        for key, entry_id, command in entries:
+            by_key.setdefault(key, []).append((entry_id, command))
+
+        for key, key_entries in by_key.items():
+            commands = [command for entry_id, command in key_entries if command is not None]
+            merged = coalesce(commands)
+            metrics.incr("daemon.coalesced", len(commands) - len(merged))
+            for command in merged:
+                try:
+                    response = await self.client.sync(loop, session, command)
+                except Exception as e:
+                    # A command which can never be sent must not block the outbox
+                    print('daemon sync error: {}'.format(e))
+                    continue
+                if response is None:
+                    return False
+            redis_server.xack(key, OUTBOX_GROUP, *[entry_id for entry_id, command in key_entries])
+        return True
+
+
+def get_outbox_key(channel):
+    return OUTBOX_KEY.format(channel)
+
+
+def get_outbox_stats(channels):
+    """
+    :return: dict of channel to "length", "pending" (delivered but not acknowledged)
+             and "lag" (seconds since the oldest entry not acknowledged was added), and "redelivered"
+    """
+    stats = {}
+    now = time.time()
+    for channel in channels:
+        key = get_outbox_key(channel)
+        pipe = redis_server.pipeline(transaction=False)
+        pipe.xlen(key)
+        pipe.xinfo_groups(key)
+        pipe.xpending(key, OUTBOX_GROUP)
+        length, groups, pending = pipe.execute(raise_on_error=False)
+        if isinstance(length, Exception):
+            raise length
+        channel_stats = {"length": length, "pending": 0, "lag": 0}
+        stats[channel] = channel_stats
+        if isinstance(groups, Exception) or isinstance(pending, Exception):
+            # No worker has ever run for the channel
+            channel_stats["lag"] = None if length else 0
+            continue
+
+        oldest = pending["min"] if pending["pending"] else None
+        channel_stats["pending"] = pending["pending"]
+        if oldest is None:
+            last_delivered = [group for group in groups if group["name"] in (OUTBOX_GROUP, OUTBOX_GROUP.encode())]
+            last_delivered = last_delivered[0]["last-delivered-id"] if last_delivered else b"0-0"
+            for entry_id, fields in redis_server.xrange(key, last_delivered, '+', count=2):
+                if entry_id != last_delivered:
+                    oldest = entry_id
+                    break
+        if oldest is not None:
+            oldest = oldest.decode('utf-8') if isinstance(oldest, bytes) else oldest
+            channel_stats["lag"] = round(max(now - int(oldest.split('-')[0]) / 1000.0, 0), 3)
+
+    redelivered = redis_server.hget(OUTBOX_STATS_KEY, "redelivered")
+    stats["redelivered"] = int(redelivered or 0)
+    return stats
+
+
+def build_daemon_command(channel, command, data, **kwargs):
+    daemon_command = {
+        "host": "server",
+        "target": channel,
+        "command": command,
+        "data": data
+    }
+    daemon_command.update(kwargs)
+    return daemon_command
+
+
+def send_daemon_command(channel, command, data, **kwargs):
+    """
+    :return: the command as sent to the daemon
+    """
+    daemon_command = build_daemon_command(channel, command, data, **kwargs)
+    try:
+        redis_server.xadd(
+            get_outbox_key(channel), {"command": json.dumps(daemon_command)}, maxlen=OUTBOX_MAXLEN, approximate=True
+        )
+        metrics.incr("daemon.queued")
+    except RedisError as e:
+        metrics.incr("daemon.dropped")
+        print('outbox error on {}: {}'.format(command, e))
+    return daemon_command
+
+
+def send_setlist(channel, version, playlist):
+    return send_daemon_command(channel, "setlist", playlist, version=version)
+
+
+def send_delta(channel, version, op):
+    """
+    Send op which turned playlist version - 1 into version
+    """
+    return send_daemon_command(channel, "delta", {"base": version - 1, "version": version, "ops": [op]})
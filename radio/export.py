@@ -0,0 +1,136 @@
+"""
+Streaming export of the catalogue and the play history as NDJSON or CSV.
+
+Rows are read with .iterator(chunk_size), a server-side cursor on Postgres, and written one at a
+time, so memory stays flat however many rows match. Iteration happens while the response streams,
+after the view returned, so the cursor must not be opened inside transaction.atomic.
+"""
+import csv
+import json
+from datetime import date, datetime, time
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_NDJSON = "ndjson"
+EXPORT_CSV = "csv"
+EXPORT_FORMATS = {
+    EXPORT_NDJSON: "application/x-ndjson",
+    EXPORT_CSV: "text/csv",
+}
+
+TRACK_EXPORT_FIELDS = (
+    'id', 'user_id',
+    'location', 'format', 'is_service',
+    'title', 'artist', 'description',
+    'bpm', 'scale',
+    'queue_in', 'queue_out', 'mix_in', 'mix_out', 'ment_in',
+    'duration', 'play_count',
+    'channel', 'uploaded_at', 'updated_at', 'last_played_at',
+)
+PLAY_HISTORY_EXPORT_FIELDS = (
+    'id', 'track_id', 'artist', 'title', 'channel', 'played_at',
+)
+
+
+class Echo(object):
+    """
+    File-like object csv.writer writes a single row to, returning it instead of buffering
+    """
+    def write(self, value):
+        return value
+
+
+def parse_export_date(value):
+    """
+    :param value: ISO 8601 date or datetime, naive ones in the current timezone
+    :raise ValueError:
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        parsed_date = parse_date(value)
+        if parsed_date is None:
+            raise ValueError("Invalid date: %s" % value)
+        parsed = datetime.combine(parsed_date, time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def filter_tracks(channel=None, date_from=None, date_to=None, uploader=None):
+    """
+    :param date_from: uploaded at or after, inclusive
+    :param date_to: uploaded before, exclusive
+    :param uploader: user id
+    """
+    from .models import (
+        Track, get_channel_filter
+    )
+
+    queryset = Track.objects.all()
+    if channel:
+        queryset = queryset.filter(get_channel_filter(channel))
+    if date_from:
+        queryset = queryset.filter(uploaded_at__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(uploaded_at__lt=date_to)
+    if uploader:
+        queryset = queryset.filter(user_id=uploader)
+    return queryset.order_by('id').values(*TRACK_EXPORT_FIELDS)
+
+
+def filter_play_history(channel=None, date_from=None, date_to=None, uploader=None):
+    """
+    :param date_from: played at or after, inclusive
+    :param date_to: played before, exclusive
+    :param uploader: user id of the played track's uploader
+    """
+    from .models import (
+        PlayHistory
+    )
+
+    queryset = PlayHistory.objects.all()
+    if channel:
+        queryset = queryset.filter(channel=channel)
+    if date_from:
+        queryset = queryset.filter(played_at__gte=date_from)
+    if date_to:
+        queryset = queryset.filter(played_at__lt=date_to)
+    if uploader:
+        queryset = queryset.filter(track__user_id=uploader)
+    return queryset.order_by('id').values(*PLAY_HISTORY_EXPORT_FIELDS)
+
+
+def to_csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return ",".join(str(item) for item in value)
+    return value
+
+
+def stream_ndjson(rows, chunk_size=EXPORT_CHUNK_SIZE):
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n"
+
+
+def stream_csv(rows, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield writer.writerow([to_csv_value(row[field]) for field in fields])
+
+
+def stream_export(rows, fields, export_format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    :param rows: .values() queryset returned by filter_tracks or filter_play_history
+    :return: generator of text lines
+    """
+    if export_format == EXPORT_CSV:
+        return stream_csv(rows, fields, chunk_size)
+    return stream_ndjson(rows, chunk_size)
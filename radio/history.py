@@ -0,0 +1,235 @@
+"""
+Write-behind buffer of PlayHistory.
+
+on_play appends each play to the PLAY_HISTORY_KEY stream once committed, and inserts the row itself
+only when Redis is unavailable. A PlayHistoryFlusher runs on every replica and the holder of the
+stream's lease reads it through a consumer group, under its own consumer name, and inserts plays
+with bulk_create once PLAY_HISTORY_BATCH_SIZE are buffered or the oldest waited
+settings.PLAY_HISTORY_FLUSH_DELAY seconds. Entries are acknowledged and deleted only after the
+insert committed, and a new holder claims and reads the unacknowledged entries again first.
+The stream entry id is stored as PlayHistory.event_id, so inserting a play twice is a no-op.
+"""
+import time
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import RedisError, ResponseError
+from . import metrics
+from .util import redis_server
+from .lease import Lease, get_consumer_name, claim_pending
+
+
+PLAY_HISTORY_KEY = "play_history"
+PLAY_HISTORY_GROUP = "history"
+PLAY_HISTORY_BATCH_SIZE = 500
+# Flushed entries are deleted, so only a long outage of the flusher reaches it. The oldest plays are lost then
+PLAY_HISTORY_MAXLEN = 1000000
+
+
+def buffer_play(track_id, artist, title, channel, played_at):
+    """
+    :raise redis.exceptions.RedisError: the play could not be buffered
+    """
+    redis_server.xadd(PLAY_HISTORY_KEY, {
+        "track_id": track_id,
+        "artist": artist or "",
+        "title": title or "",
+        "channel": channel,
+        "played_at": played_at,
+    }, maxlen=PLAY_HISTORY_MAXLEN, approximate=True)
+
+
+def insert_play(track_id, artist, title, channel, played_at):
+    from .models import PlayHistory
+
+    PlayHistory.objects.create(
+        track_id=track_id, artist=artist, title=title, channel=channel, played_at=played_at
+    )
+
+
+def buffer_play_on_commit(track_id, artist, title, channel, played_at):
+    """
+    buffer_play for transaction.on_commit, inserting the play right away if it can not be buffered
+    """
+    try:
+        buffer_play(track_id, artist, title, channel, played_at)
+        return
+    except RedisError as e:
+        print('play history buffer error: {}'.format(e))
+
+    try:
+        insert_play(track_id, artist, title, channel, played_at)
+        metrics.incr("history.unbuffered")
+    except Exception as e:
+        # The play is counted already, only its history is lost
+        print('play history insert error: {}'.format(e))
+        metrics.incr("history.dropped")
+
+
+def get_buffered_plays():
+    """
+    :return: (number of plays not inserted yet, seconds the oldest one has waited)
+    """
+    pipe = redis_server.pipeline(transaction=False)
+    pipe.xlen(PLAY_HISTORY_KEY)
+    pipe.xrange(PLAY_HISTORY_KEY, '-', '+', count=1)
+    length, oldest = pipe.execute()
+    if not oldest:
+        return length, 0
+    return length, max(time.time() - get_entry_timestamp(oldest[0][0]), 0)
+
+
+def get_entry_timestamp(entry_id):
+    entry_id = entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id
+    return int(entry_id.split('-')[0]) / 1000.0
+
+
+def decode_play(entry_id, fields):
+    fields = {key.decode('utf-8'): value.decode('utf-8') for key, value in fields.items()}
+    return {
+        "event_id": entry_id.decode('utf-8') if isinstance(entry_id, bytes) else entry_id,
+        "track_id": int(fields["track_id"]),
+        "artist": fields["artist"] or None,
+        "title": fields["title"] or None,
+        "channel": fields["channel"],
+        "played_at": fields["played_at"],
+    }
+
+
+class PlayHistoryFlusher(object):
+    """
+    Flushes the buffered plays while it holds the lease of the stream
+    """
+    def __init__(self, batch_size=PLAY_HISTORY_BATCH_SIZE, delay=None):
+        self.batch_size = batch_size
+        self.delay = settings.PLAY_HISTORY_FLUSH_DELAY if delay is None else delay
+        self.consumer = get_consumer_name()
+        self.lease = Lease(PLAY_HISTORY_KEY, self.consumer)
+
+    def create_group(self):
+        try:
+            redis_server.xgroup_create(PLAY_HISTORY_KEY, PLAY_HISTORY_GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, replay, block):
+        """
+        :param replay: read the entries read before but not acknowledged instead of new ones
+        :return: list of (entry id, fields)
+        """
+        response = redis_server.xreadgroup(
+            PLAY_HISTORY_GROUP, self.consumer, {PLAY_HISTORY_KEY: '0' if replay else '>'},
+            count=self.batch_size, block=None if replay else block
+        )
+        entries = []
+        for key, stream_entries in response or []:
+            entries += stream_entries
+        return entries
+
+    def run(self):
+        self.create_group()
+        try:
+            self.work()
+        finally:
+            try:
+                self.lease.release()
+            except RedisError:
+                pass
+
+    def work(self):
+        replay = True
+        batch = []
+        while True:
+            try:
+                if self.lease.hold():
+                    # Whatever a previous holder did not acknowledge goes first
+                    claim_pending(PLAY_HISTORY_KEY, PLAY_HISTORY_GROUP, self.consumer)
+                    replay = True
+                if not self.lease.held:
+                    # Another replica flushes, what was read is claimed and flushed by it
+                    batch = []
+                    time.sleep(1)
+                    continue
+
+                if replay:
+                    batch = self.read(True, None)
+                    if batch:
+                        metrics.incr("history.redelivered", len(batch))
+                        self.flush(batch)
+                    else:
+                        replay = False
+                    batch = []
+                    continue
+
+                wait = self.delay
+                if batch:
+                    wait -= time.time() - get_entry_timestamp(batch[0][0])
+                    if wait <= 0 or len(batch) >= self.batch_size:
+                        self.flush(batch)
+                        batch = []
+                        continue
+                batch += self.read(False, max(int(min(wait, 1) * 1000), 1))
+            except Exception as e:
+                # Nothing of the batch was acknowledged, it is read again from the pending entries
+                print('play history flush error: {}'.format(e))
+                self.lease.held = False
+                batch = []
+                replay = True
+                time.sleep(1)
+
+    def drain(self):
+        """
+        Flush everything buffered, unacknowledged entries of every consumer first, and return
+
+        :return: number of plays flushed
+        """
+        self.create_group()
+        claim_pending(PLAY_HISTORY_KEY, PLAY_HISTORY_GROUP, self.consumer)
+        flushed = 0
+        for replay in (True, False):
+            while True:
+                entries = self.read(replay, None)
+                if not entries:
+                    break
+                self.flush(entries)
+                flushed += len(entries)
+        return flushed
+
+    def flush(self, entries):
+        """
+        Insert entries and acknowledge them once committed. Entries which were inserted before are skipped
+        """
+        from .models import Track, PlayHistory
+
+        plays = []
+        acknowledged = []
+        for entry_id, fields in entries:
+            acknowledged.append(entry_id)
+            # Fields of an entry deleted while pending are empty
+            if fields:
+                plays.append(decode_play(entry_id, fields))
+
+        if plays:
+            # A track deleted meanwhile keeps its history as on_delete=SET_NULL would.
+            # Soft deleted tracks still exist until purged
+            existing = set(Track.all_objects.filter(
+                id__in={play["track_id"] for play in plays}
+            ).values_list('id', flat=True))
+            with transaction.atomic():
+                PlayHistory.objects.bulk_create([
+                    PlayHistory(
+                        event_id=play["event_id"],
+                        track_id=play["track_id"] if play["track_id"] in existing else None,
+                        artist=play["artist"],
+                        title=play["title"],
+                        channel=play["channel"],
+                        played_at=play["played_at"],
+                    ) for play in plays
+                ], ignore_conflicts=True)
+
+        # Should this fail, the inserted rows are skipped by event_id when read again
+        pipe = redis_server.pipeline(transaction=True)
+        pipe.xack(PLAY_HISTORY_KEY, PLAY_HISTORY_GROUP, *acknowledged)
+        pipe.xdel(PLAY_HISTORY_KEY, *acknowledged)
+        pipe.execute()
+        metrics.incr("history.flushed", len(plays))
@@ -0,0 +1,396 @@
+import re
+import json
+import random
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from dateutil.tz import tzlocal
+from django.db.models import Q
+from .models import CHANNEL, Track
+from .util import redis_server, LOCKOUT_PLAYED, LOCKOUT_UPLOADED
+
+
+ELIGIBLE_INDEX_KEY = "eligible:{}"
+# Set by a completed rebuild only. index_track creates the index key too, holding just the tracks saved since
+ELIGIBLE_READY_KEY = "eligible_ready:{}"
+
+HARMONIC_BUCKET_KEY = "harmonic:{}:{}:{}"
+HARMONIC_TRACK_KEY = "harmonic:track"
+
+# Width of a BPM band. A pick looks at the now playing band and its neighbours
+HARMONIC_BPM_BAND = 4.0
+HARMONIC_BPM_TOLERANCE = 4.0
+# Random members drawn from each compatible bucket per pick
+HARMONIC_CANDIDATES = 8
+
+# A rebuild replays the tracks changed since it started, less this margin for requests
+# which wrote their timestamp before it started but committed after it read the table
+REBUILD_REPLAY_MARGIN = timedelta(minutes=1)
+
+NOTE_PITCH = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+CAMELOT_PATTERN = re.compile(r"^(1[0-2]|[1-9])\s*([AB])$", re.IGNORECASE)
+SCALE_PATTERN = re.compile(r"^([A-G])\s*(#|\u266f|b|\u266d)?\s*(.*)$", re.IGNORECASE)
+
+
+def get_eligible_index_key(channel):
+    return ELIGIBLE_INDEX_KEY.format(channel)
+
+
+def get_eligible_ready_key(channel):
+    return ELIGIBLE_READY_KEY.format(channel)
+
+
+def get_eligible_score(last_played_at, uploaded_at):
+    """
+    Score of a track in the eligible index
+
+    A played track becomes eligible LOCKOUT_PLAYED after last_played_at.
+    A never played track becomes eligible LOCKOUT_UPLOADED after uploaded_at,
+    so it is scored as if it was played at uploaded_at + LOCKOUT_UPLOADED - LOCKOUT_PLAYED.
+    Both cases become a single "score < now - LOCKOUT_PLAYED" range.
+    """
+    if isinstance(last_played_at, str):
+        last_played_at = parse(last_played_at)
+    if isinstance(uploaded_at, str):
+        uploaded_at = parse(uploaded_at)
+
+    if last_played_at is not None:
+        return last_played_at.timestamp()
+    if uploaded_at is None:
+        uploaded_at = datetime.now(tz=tzlocal())
+    return (uploaded_at + LOCKOUT_UPLOADED - LOCKOUT_PLAYED).timestamp()
+
+
+def get_camelot(scale):
+    """
+    Convert a free text scale like "Am", "F# minor", "Bb major" or "8A" to camelot notation
+
+    :return: (number, letter) tuple. None if scale can not be parsed
+    """
+    if not scale:
+        return None
+    scale = scale.strip()
+
+    match = CAMELOT_PATTERN.match(scale)
+    if match:
+        return int(match.group(1)), match.group(2).upper()
+
+    match = SCALE_PATTERN.match(scale)
+    if not match:
+        return None
+    note, accidental, mode = match.groups()
+    pitch = NOTE_PITCH[note.upper()]
+    if accidental in ("#", "\u266f"):
+        pitch += 1
+    elif accidental is not None:
+        pitch -= 1
+
+    mode = mode.strip().lower()
+    if mode in ("", "maj", "major", "dur"):
+        letter = "B"
+    elif mode in ("m", "min", "minor", "moll"):
+        # Camelot number of a minor key is the one of its relative major
+        letter = "A"
+        pitch += 3
+    else:
+        return None
+
+    # Walk the circle of fifths from C major = 8B
+    number = ((pitch % 12) * 7 + 7) % 12 + 1
+    return number, letter
+
+
+def get_compatible_camelot(camelot):
+    """
+    Same key, one step around the wheel and the relative major/minor
+    """
+    number, letter = camelot
+    other_letter = "B" if letter == "A" else "A"
+    return [
+        (number, letter),
+        (number % 12 + 1, letter),
+        ((number - 2) % 12 + 1, letter),
+        (number, other_letter),
+    ]
+
+
+def get_bpm_band(bpm):
+    return int(bpm // HARMONIC_BPM_BAND)
+
+
+def get_harmonic_bucket_key(channel, camelot, band):
+    return HARMONIC_BUCKET_KEY.format(channel, "%d%s" % camelot, band)
+
+
+def get_harmonic_entry(track):
+    camelot = get_camelot(track.scale)
+    if camelot is None or track.bpm is None:
+        return None
+    return {
+        "camelot": list(camelot),
+        "bpm": float(track.bpm),
+        "channel": list(track.channel),
+    }
+
+
+def _remove_harmonic_entry(pipe, track_id, entry):
+    camelot = tuple(entry["camelot"])
+    band = get_bpm_band(entry["bpm"])
+    for channel in entry["channel"]:
+        pipe.srem(get_harmonic_bucket_key(channel, camelot, band), track_id)
+
+
+def index_track(track, pipeline=None):
+    """
+    Add track to the eligible and harmonic index of its channels and remove it from the others
+    """
+    old_entry = redis_server.hget(HARMONIC_TRACK_KEY, track.id)
+    entry = get_harmonic_entry(track)
+
+    pipe = pipeline if pipeline is not None else redis_server.pipeline(transaction=False)
+    score = get_eligible_score(track.last_played_at, track.uploaded_at)
+    for channel, _ in CHANNEL:
+        key = get_eligible_index_key(channel)
+        if channel in track.channel:
+            pipe.zadd(key, {track.id: score})
+        else:
+            pipe.zrem(key, track.id)
+
+    if old_entry is not None:
+        _remove_harmonic_entry(pipe, track.id, json.loads(old_entry))
+    if entry is None:
+        pipe.hdel(HARMONIC_TRACK_KEY, track.id)
+    else:
+        band = get_bpm_band(entry["bpm"])
+        for channel in entry["channel"]:
+            pipe.sadd(get_harmonic_bucket_key(channel, tuple(entry["camelot"]), band), track.id)
+        pipe.hset(HARMONIC_TRACK_KEY, track.id, json.dumps(entry))
+
+    if pipeline is None:
+        pipe.execute()
+
+
+def mark_track_played(track_id, last_played_at, pipeline=None):
+    """
+    Rescore a played track in the eligible index of the channels already holding it.
+    on_play updates the row without loading it, so its channels are not known here
+    """
+    score = get_eligible_score(last_played_at, None)
+
+    pipe = pipeline if pipeline is not None else redis_server.pipeline(transaction=False)
+    for channel, _ in CHANNEL:
+        pipe.zadd(get_eligible_index_key(channel), {track_id: score}, xx=True)
+    if pipeline is None:
+        pipe.execute()
+
+
+def unindex_track(track_id, pipeline=None):
+    old_entry = redis_server.hget(HARMONIC_TRACK_KEY, track_id)
+
+    pipe = pipeline if pipeline is not None else redis_server.pipeline(transaction=False)
+    for channel, _ in CHANNEL:
+        pipe.zrem(get_eligible_index_key(channel), track_id)
+    if old_entry is not None:
+        _remove_harmonic_entry(pipe, track_id, json.loads(old_entry))
+        pipe.hdel(HARMONIC_TRACK_KEY, track_id)
+    if pipeline is None:
+        pipe.execute()
+
+
+def is_eligible_index_ready(channel):
+    """
+    :return: True once rebuild_eligible_index completed since Redis last lost its data
+    """
+    return redis_server.exists(get_eligible_ready_key(channel)) > 0
+
+
+def is_track_eligible(channel, track_id):
+    score = redis_server.zscore(get_eligible_index_key(channel), track_id)
+    if score is None:
+        return False
+    return score < (datetime.now(tz=tzlocal()) - LOCKOUT_PLAYED).timestamp()
+
+
+def pick_eligible_track_ids(channel, samples, exclude_ids=None):
+    """
+    Pick random eligible track ids of channel from the index
+
+    Eligible tracks are the lowest ranks of the sorted set, so a pick is a
+    ZCOUNT plus one O(log n) ZRANGE per wanted rank, all in one round-trip.
+
+    :return: list of track id. Empty if no track is eligible
+    """
+    exclude_ids = set(int(track_id) for track_id in (exclude_ids or []))
+    key = get_eligible_index_key(channel)
+    base_time = datetime.now(tz=tzlocal()) - LOCKOUT_PLAYED
+
+    count = redis_server.zcount(key, "-inf", "(%f" % base_time.timestamp())
+    if count < 1:
+        return []
+
+    pipe = redis_server.pipeline(transaction=False)
+    for rank in random.sample(range(count), min(count, samples + len(exclude_ids))):
+        pipe.zrange(key, rank, rank)
+
+    track_ids = []
+    for members in pipe.execute():
+        for member in members:
+            track_id = int(member)
+            if track_id not in exclude_ids:
+                track_ids.append(track_id)
+    return track_ids[:samples]
+
+
+def pick_harmonic_track_ids(channel, previous_track_id, samples, exclude_ids=None):
+    """
+    Pick eligible tracks which mix harmonically after previous_track_id
+
+    Candidates come from the camelot compatible buckets of the previous track's
+    BPM band and its neighbours, so a pick costs three round-trips regardless
+    of the catalogue size. Each pick is anchored on the one before it.
+
+    :return: list of track id. Shorter than samples or empty if the compatible set runs out
+    """
+    exclude_ids = set(int(track_id) for track_id in (exclude_ids or []))
+    base_score = (datetime.now(tz=tzlocal()) - LOCKOUT_PLAYED).timestamp()
+    eligible_key = get_eligible_index_key(channel)
+
+    track_ids = []
+    previous_entry = redis_server.hget(HARMONIC_TRACK_KEY, previous_track_id)
+    while previous_entry is not None and len(track_ids) < samples:
+        previous_entry = json.loads(previous_entry)
+        previous_bpm = previous_entry["bpm"]
+        band = get_bpm_band(previous_bpm)
+
+        pipe = redis_server.pipeline(transaction=False)
+        for camelot in get_compatible_camelot(tuple(previous_entry["camelot"])):
+            for candidate_band in (band - 1, band, band + 1):
+                pipe.srandmember(get_harmonic_bucket_key(channel, camelot, candidate_band), HARMONIC_CANDIDATES)
+
+        candidates = set()
+        for members in pipe.execute():
+            candidates.update(int(member) for member in members)
+        candidates = list(candidates - exclude_ids)
+        if not candidates:
+            break
+
+        pipe = redis_server.pipeline(transaction=False)
+        pipe.hmget(HARMONIC_TRACK_KEY, candidates)
+        for track_id in candidates:
+            pipe.zscore(eligible_key, track_id)
+        result = pipe.execute()
+
+        matches = []
+        for track_id, entry, score in zip(candidates, result[0], result[1:]):
+            if entry is None or score is None or score >= base_score:
+                continue
+            if abs(json.loads(entry)["bpm"] - previous_bpm) <= HARMONIC_BPM_TOLERANCE:
+                matches.append((track_id, entry))
+        if not matches:
+            break
+
+        track_id, previous_entry = random.choice(matches)
+        track_ids.append(track_id)
+        exclude_ids.add(track_id)
+
+    return track_ids
+
+
+def replay_index_changes(since):
+    """
+    Index the tracks changed, played or deleted since `since` again from their rows.
+    Run after a rebuild swapped its keys in: writes made while it read the table went to
+    the keys it replaced, and any made after the swap already reached the live ones
+
+    :return: number of replayed tracks
+    """
+    changed = Track.all_objects.filter(
+        Q(updated_at__gte=since) | Q(last_played_at__gte=since) | Q(deleted_at__gte=since)
+    ).only('id', 'channel', 'bpm', 'scale', 'last_played_at', 'uploaded_at', 'deleted_at')
+
+    replayed = 0
+    pipe = redis_server.pipeline(transaction=False)
+    for track in changed.iterator(chunk_size=2000):
+        if track.deleted_at is None:
+            index_track(track, pipe)
+        else:
+            unindex_track(track.id, pipe)
+        replayed += 1
+        if replayed % 1000 == 0:
+            pipe.execute()
+    pipe.execute()
+    return replayed
+
+
+def rebuild_eligible_index():
+    """
+    Reconstruct the eligible index of every channel from the Track table.
+    Each channel is built under a temporary key and swapped in with RENAME,
+    then the changes made meanwhile are replayed and the index is marked ready
+
+    :return: dict of channel and number of indexed tracks
+    """
+    started = datetime.now(tz=tzlocal()) - REBUILD_REPLAY_MARGIN
+    building = {}
+    for channel, _ in CHANNEL:
+        building[channel] = {}
+
+    tracks = Track.objects.values_list('id', 'channel', 'last_played_at', 'uploaded_at')
+    for track_id, channels, last_played_at, uploaded_at in tracks.iterator(chunk_size=2000):
+        score = get_eligible_score(last_played_at, uploaded_at)
+        for channel in channels:
+            if channel in building:
+                building[channel][track_id] = score
+
+    result = {}
+    for channel, mapping in building.items():
+        key = get_eligible_index_key(channel)
+        temp_key = "%s:rebuild" % key
+        redis_server.delete(temp_key)
+        track_ids = list(mapping.keys())
+        for offset in range(0, len(track_ids), 1000):
+            redis_server.zadd(temp_key, {
+                track_id: mapping[track_id] for track_id in track_ids[offset:offset + 1000]
+            })
+        if track_ids:
+            redis_server.rename(temp_key, key)
+        else:
+            redis_server.delete(key)
+        result[channel] = len(track_ids)
+    replay_index_changes(started)
+    redis_server.mset({get_eligible_ready_key(channel): 1 for channel in building})
+    return result
+
+
+def rebuild_harmonic_index():
+    """
+    Reconstruct the harmonic buckets of every channel from the Track table,
+    then replay the changes made meanwhile
+
+    :return: number of indexed tracks
+    """
+    started = datetime.now(tz=tzlocal()) - REBUILD_REPLAY_MARGIN
+    buckets = {}
+    entries = {}
+    tracks = Track.objects.only('id', 'channel', 'bpm', 'scale')
+    for track in tracks.iterator(chunk_size=2000):
+        entry = get_harmonic_entry(track)
+        if entry is None:
+            continue
+        entries[track.id] = json.dumps(entry)
+        band = get_bpm_band(entry["bpm"])
+        for channel in entry["channel"]:
+            key = get_harmonic_bucket_key(channel, tuple(entry["camelot"]), band)
+            buckets.setdefault(key, []).append(track.id)
+
+    stale_keys = list(redis_server.scan_iter(match=HARMONIC_BUCKET_KEY.format("*", "*", "*")))
+    pipe = redis_server.pipeline(transaction=True)
+    if stale_keys:
+        pipe.delete(*stale_keys)
+    pipe.delete(HARMONIC_TRACK_KEY)
+    for key, track_ids in buckets.items():
+        pipe.sadd(key, *track_ids)
+    if entries:
+        pipe.hset(HARMONIC_TRACK_KEY, mapping=entries)
+    pipe.execute()
+    replay_index_changes(started)
+    return len(entries)
@@ -0,0 +1,107 @@
+"""
+Redis leases electing the one replica which runs a background job.
+
+Every container may start the outbox worker, the play history flusher and the purge loop; each
+job holds a lease, a key set with NX PX to the consumer name of its holder, and only works while
+it holds it. The holder renews it at every iteration, well within LEASE_TTL, and another replica
+takes over once a holder which died or lost Redis lets it expire. A new holder of a stream claims
+the entries its predecessor read without acknowledging with XAUTOCLAIM, so they are sent again.
+"""
+import os
+import socket
+from redis.exceptions import ResponseError
+from .util import redis_server
+
+
+LEASE_KEY = "lease:{}"
+# Milliseconds a holder which stopped renewing keeps the job
+LEASE_TTL = 15000
+# Seconds between renewals, two of them may fail before the lease is lost
+LEASE_RENEW_INTERVAL = LEASE_TTL / 3000.0
+LEASE_CLAIM_BATCH = 1000
+
+# Renew only a lease still held, one which expired meanwhile may belong to another replica
+RENEW_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+renew_lease_script = redis_server.register_script(RENEW_LEASE)
+release_lease_script = redis_server.register_script(RELEASE_LEASE)
+
+
+def get_consumer_name():
+    """
+    :return: name of this process, unique among replicas and across restarts
+    """
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def get_lease_key(name):
+    return LEASE_KEY.format(name)
+
+
+class Lease(object):
+    """
+    Lease of the job name held by consumer, lost ttl milliseconds after the last renewal
+    """
+    def __init__(self, name, consumer, ttl=LEASE_TTL):
+        self.key = get_lease_key(name)
+        self.consumer = consumer
+        self.ttl = ttl
+        self.held = False
+
+    def hold(self):
+        """
+        Renew the lease, or acquire it if free
+
+        :return: True if acquired by this call, False if renewed or held by another replica, see held
+        :raise RedisError:
+        """
+        was_held = self.held
+        self.held = bool(renew_lease_script(keys=[self.key], args=[self.consumer, self.ttl]))
+        if not self.held:
+            self.held = bool(redis_server.set(self.key, self.consumer, nx=True, px=self.ttl))
+        return self.held and not was_held
+
+    def release(self):
+        self.held = False
+        release_lease_script(keys=[self.key], args=[self.consumer])
+
+
+def claim_pending(key, group, consumer):
+    """
+    Take over the entries of key read by other consumers of group but not acknowledged, and
+    delete those consumers, so the entries are read again with id '0' by consumer
+
+    :return: number of entries claimed
+    :raise RedisError:
+    """
+    claimed = 0
+    start = '0-0'
+    while True:
+        response = redis_server.xautoclaim(
+            key, group, consumer, min_idle_time=0, start_id=start, count=LEASE_CLAIM_BATCH, justid=True
+        )
+        start, entry_ids = response[0], response[1]
+        claimed += len(entry_ids)
+        if start in (b'0-0', '0-0'):
+            break
+
+    try:
+        consumers = redis_server.xinfo_consumers(key, group)
+    except ResponseError:
+        return claimed
+    for info in consumers:
+        name = info["name"].decode('utf-8') if isinstance(info["name"], bytes) else info["name"]
+        if name != consumer and not info["pending"]:
+            redis_server.xgroup_delconsumer(key, group, name)
+    return claimed
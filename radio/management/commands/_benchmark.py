@@ -0,0 +1,72 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from dateutil.tz import tzlocal
+from django.contrib.auth import get_user_model
+from radio.models import DEFAULT_CHANNEL, Track
+
+
+SEED_BATCH_SIZE = 10000
+
+
+class Rollback(Exception):
+    """
+    Raised at the end of a benchmark to throw away the seeded rows
+    """
+    pass
+
+
+def create_benchmark_user():
+    User = get_user_model()
+    return User.objects.create_user(
+        "benchmark-%s@example.com" % uuid.uuid4().hex, "benchmark", "benchmark", uuid.uuid4().hex
+    )
+
+
+def seed_tracks(user, count, channel=DEFAULT_CHANNEL, start=0):
+    """
+    Bulk insert `count` playable tracks uploaded an hour ago
+
+    :return: list of inserted track id
+    """
+    track_ids = []
+    uploaded_at = datetime.now(tz=tzlocal()) - timedelta(hours=1)
+    for offset in range(0, count, SEED_BATCH_SIZE):
+        batch = []
+        for index in range(start + offset, start + min(offset + SEED_BATCH_SIZE, count)):
+            batch.append(Track(
+                user=user,
+                location="benchmark/%d.mp3" % index,
+                title="Benchmark Title %d" % index,
+                artist="Benchmark Artist %d" % (index % 997),
+                duration="00:05:00",
+                channel=[channel],
+            ))
+        created = Track.objects.bulk_create(batch)
+        track_ids += [track.id for track in created]
+
+    # auto_now_add ignores the value given on insert
+    Track.objects.filter(id__in=track_ids).update(uploaded_at=uploaded_at)
+    return track_ids
+
+
+def timeit(function, repeat):
+    """
+    :return: (best, average) elapsed milliseconds of `repeat` runs
+    """
+    elapsed = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed.append((time.perf_counter() - started) * 1000)
+    return min(elapsed), sum(elapsed) / len(elapsed)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of values, fraction between 0 and 1
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
@@ -0,0 +1,66 @@
+"""
+Stand-in music daemon speaking the playlist sync protocol of radio.daemon,
+and the legacy unqueue command {"index_at": index} which carries no version
+"""
+import json
+from aiohttp import web
+from radio.daemon import apply_delta
+
+
+class MockDaemon(object):
+    def __init__(self):
+        self.channels = {}
+        self.commands = 0
+        self.gaps = 0
+
+    def get_channel(self, channel):
+        return self.channels.setdefault(channel, {"version": 0, "playlist": []})
+
+    def handle_command(self, command):
+        self.commands += 1
+        state = self.get_channel(command["target"])
+
+        if command["command"] == "setlist":
+            # A setlist older than what was applied is a late retry
+            if command.get("version", state["version"]) >= state["version"]:
+                state["playlist"] = list(command["data"])
+                state["version"] = command.get("version", state["version"])
+        elif command["command"] == "delta":
+            delta = command["data"]
+            if delta["version"] <= state["version"]:
+                # Already applied, delivery is at least once
+                pass
+            elif delta["base"] != state["version"]:
+                self.gaps += 1
+                return {"status": "gap", "version": state["version"]}
+            else:
+                playlist = list(state["playlist"])
+                try:
+                    for op in delta["ops"]:
+                        apply_delta(playlist, op)
+                except IndexError:
+                    self.gaps += 1
+                    return {"status": "gap", "version": state["version"]}
+                state["playlist"] = playlist
+                state["version"] = delta["version"]
+        elif command["command"] == "unqueue":
+            index = command["data"]["index_at"]
+            if -len(state["playlist"]) <= index < len(state["playlist"]):
+                state["playlist"].pop(index)
+        return {"status": "ok", "version": state["version"]}
+
+    async def handle_post(self, request):
+        return web.json_response(self.handle_command(json.loads(await request.read())))
+
+    async def handle_state(self, request):
+        return web.json_response({
+            "commands": self.commands,
+            "gaps": self.gaps,
+            "channels": self.channels,
+        })
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/", self.handle_post)
+        app.router.add_get("/state", self.handle_state)
+        return app
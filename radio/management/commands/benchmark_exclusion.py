@@ -0,0 +1,69 @@
+import random
+from datetime import datetime
+from dateutil.tz import tzlocal
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from radio.models import DEFAULT_CHANNEL, Track, get_channel_filter
+from radio.util import LOCKOUT_PLAYED, LOCKOUT_UPLOADED, PLAYLIST_FIELDS, NUM_SAMPLES
+from ._benchmark import Rollback, create_benchmark_user, seed_tracks, timeit
+
+
+def eligible_queryset():
+    now = datetime.now(tz=tzlocal())
+    filter_track = Q(last_played_at__lt=now - LOCKOUT_PLAYED)
+    filter_track_not_play = Q(last_played_at__isnull=True, uploaded_at__lt=now - LOCKOUT_UPLOADED)
+    return Track.objects.filter(get_channel_filter(DEFAULT_CHANNEL)).filter(filter_track | filter_track_not_play)
+
+
+def chained_queryset(exclude_ids):
+    # One nested filter per excluded track as get_random_track used to build
+    queryset = eligible_queryset()
+    for track_id in exclude_ids:
+        queryset = queryset.filter(~Q(id=track_id))
+    return queryset.order_by('?')[:1]
+
+
+def set_queryset(exclude_ids):
+    return eligible_queryset().exclude(id__in=exclude_ids).order_by('?').only(*PLAYLIST_FIELDS)[:1]
+
+
+def compile_sql(build, exclude_ids):
+    queryset = build(exclude_ids)
+    return queryset.query.get_compiler(using=queryset.db).as_sql()
+
+
+class Command(BaseCommand):
+    help = "Measure SQL compile and execution time of chained per-track exclusion filters " \
+           "against a single set-based exclusion. Seeded tracks are rolled back at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=100000)
+        parser.add_argument('--excludes', default="%d,100,500" % NUM_SAMPLES, help="Comma separated exclusion sizes")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['tracks'], [int(size) for size in options['excludes'].split(",")], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, tracks, excludes, repeat):
+        user = create_benchmark_user()
+        track_ids = seed_tracks(user, tracks)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE %s" % Track._meta.db_table)
+
+        for size in excludes:
+            exclude_ids = random.sample(track_ids, min(size, len(track_ids)))
+            self.stdout.write("%d tracks, %d excluded" % (tracks, len(exclude_ids)))
+            for name, build in (("chained", chained_queryset), ("set", set_queryset)):
+                compile_best, compile_average = timeit(lambda: compile_sql(build, exclude_ids), repeat)
+                execute_best, execute_average = timeit(lambda: list(build(exclude_ids)), repeat)
+                self.stdout.write(
+                    "  %-8s compile best %8.3f ms avg %8.3f ms | compile+execute best %8.2f ms avg %8.2f ms" % (
+                        name, compile_best, compile_average, execute_best, execute_average
+                    )
+                )
@@ -0,0 +1,115 @@
+import json
+import time
+import uuid
+import random
+import threading
+from django.core.management.base import BaseCommand
+from radio.util import (
+    redis_server, get_playlist_key, get_now_playing_key, get_channel_version_key, get_channel_version,
+    get_playlist_version_key,
+    append_playlist, insert_playlist, move_playlist, remove_playlist, replace_playlist
+)
+
+
+def legacy_append(channel, entry):
+    # GET, json.loads, modify, json.dumps, SET as the single document format did
+    raw_json = redis_server.get(channel)
+    redis_data = json.loads(raw_json) if raw_json is not None else {"now_playing": None, "playlist": []}
+    redis_data["playlist"] = (redis_data["playlist"] or []) + [entry]
+    redis_server.set(channel, json.dumps(redis_data, ensure_ascii=False).encode('utf-8'))
+
+
+class MixedWriter(object):
+    """
+    Random script mutations. Successful ones are counted to check the final length and version
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.length_delta = 0
+        self.mutations = 0
+
+    def __call__(self, channel, entry):
+        operation = random.random()
+        try:
+            if operation < 0.4:
+                append_playlist(channel, entry)
+                delta = 1
+            elif operation < 0.7:
+                insert_playlist(channel, random.randint(0, 20), entry)
+                delta = 1
+            elif operation < 0.85:
+                move_playlist(channel, random.randint(0, 20), random.randint(0, 20))
+                delta = 0
+            else:
+                remove_playlist(channel, random.randint(0, 20))
+                delta = -1
+        except IndexError:
+            return
+        with self.lock:
+            self.length_delta += delta
+            self.mutations += 1
+
+
+def run_writers(function, channel, writers, operations):
+    def write(writer):
+        for index in range(operations):
+            function(channel, {
+                "id": writer * operations + index,
+                "location": "/srv/media/benchmark.mp3",
+                "artist": "Benchmark",
+                "title": "Writer %d op %d" % (writer, index)
+            })
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = "Measure playlist mutation throughput and lost updates under concurrent writers " \
+           "for the legacy JSON document and the Lua playlist scripts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=500, help="Operations per writer")
+
+    def handle(self, *args, **options):
+        writers = options['writers']
+        operations = options['operations']
+        expected = writers * operations
+        channel = "benchmark-%s" % uuid.uuid4().hex
+        keys = [channel, get_playlist_key(channel), get_now_playing_key(channel),
+                get_channel_version_key(channel), get_playlist_version_key(channel)]
+
+        try:
+            elapsed = run_writers(legacy_append, channel, writers, operations)
+            length = len(json.loads(redis_server.get(channel))["playlist"])
+            self.report("legacy append", expected, elapsed, length)
+
+            elapsed = run_writers(append_playlist, channel, writers, operations)
+            length = redis_server.llen(get_playlist_key(channel))
+            self.report("script append", expected, elapsed, length)
+
+            replace_playlist(channel, [{"id": -index} for index in range(1, 22)])
+            version = get_channel_version(channel)
+            writer = MixedWriter()
+            elapsed = run_writers(writer, channel, writers, operations)
+            self.report("script mixed", expected, elapsed, None)
+
+            length = redis_server.llen(get_playlist_key(channel))
+            self.stdout.write("length %d expected %d, version +%d expected +%d" % (
+                length, 21 + writer.length_delta,
+                get_channel_version(channel) - version, writer.mutations
+            ))
+        finally:
+            redis_server.delete(*keys)
+
+    def report(self, name, expected, elapsed, length):
+        line = "%-14s %8.0f ops/s" % (name, expected / elapsed)
+        if length is not None:
+            line += "  lost updates %d/%d" % (expected - length, expected)
+        self.stdout.write(line)
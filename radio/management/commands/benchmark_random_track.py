@@ -0,0 +1,86 @@
+import random
+import tracemalloc
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from radio.models import DEFAULT_CHANNEL, Track, get_channel_filter
+from radio.util import (
+    sample_tracks, reset_track_id_bounds, SAMPLE_STRATEGY_ID_RANGE, SAMPLE_STRATEGY_TABLESAMPLE, NUM_SAMPLES
+)
+from ._benchmark import Rollback, create_benchmark_user, seed_tracks, timeit
+
+
+def legacy_random_track(queryset, samples):
+    # The path get_random_track used before database side sampling
+    if queryset.count() < 1:
+        return []
+    count_track = queryset.count()
+    if count_track > samples:
+        count_track = samples
+    return random.sample(list(queryset), count_track)
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+class Command(BaseCommand):
+    help = "Compare get_random_track sampling strategies against the legacy in-memory sample. " \
+           "Seeded tracks are rolled back at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default="1000,100000,1000000", help="Comma separated catalogue sizes")
+        parser.add_argument('--samples', type=int, default=NUM_SAMPLES)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument(
+            '--legacy-limit', type=int, default=1000000,
+            help="Skip the legacy path above this catalogue size"
+        )
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(","))
+        samples = options['samples']
+        repeat = options['repeat']
+
+        try:
+            with transaction.atomic():
+                self.run(sizes, samples, repeat, options['legacy_limit'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, sizes, samples, repeat, legacy_limit):
+        user = create_benchmark_user()
+        queryset = Track.objects.filter(get_channel_filter(DEFAULT_CHANNEL))
+
+        seeded = 0
+        for size in sizes:
+            seed_tracks(user, size - seeded, start=seeded)
+            seeded = size
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE %s" % Track._meta.db_table)
+            reset_track_id_bounds()
+
+            paths = [
+                ("db:auto", lambda: sample_tracks(queryset, samples)),
+                ("db:%s" % SAMPLE_STRATEGY_ID_RANGE, lambda: sample_tracks(
+                    queryset, samples, [SAMPLE_STRATEGY_ID_RANGE])),
+                ("db:%s" % SAMPLE_STRATEGY_TABLESAMPLE, lambda: sample_tracks(
+                    queryset, samples, [SAMPLE_STRATEGY_TABLESAMPLE])),
+                ("db:order_random", lambda: sample_tracks(queryset, samples, [])),
+            ]
+            if size <= legacy_limit:
+                paths.insert(0, ("legacy", lambda: legacy_random_track(queryset, samples)))
+
+            self.stdout.write("%d tracks, %d samples" % (size, samples))
+            for name, function in paths:
+                best, average = timeit(function, repeat)
+                memory = peak_memory(function)
+                self.stdout.write("  %-18s best %9.2f ms  avg %9.2f ms  peak %8.2f MiB" % (
+                    name, best, average, memory
+                ))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from radio.models import Track
+from radio.views import get_tracks_after, encode_track_cursor
+from ._benchmark import Rollback, create_benchmark_user, seed_tracks, timeit
+
+
+class Command(BaseCommand):
+    help = "Measure a track list page at increasing depth with offset slicing and with the keyset cursor. " \
+           "Seeded tracks are rolled back at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=200000)
+        parser.add_argument('--limit', type=int, default=30)
+        parser.add_argument('--pages', default="0,100,1000,5000", help="Comma separated page numbers")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['tracks'], options['limit'],
+                         [int(page) for page in options['pages'].split(",")], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, tracks, limit, pages, repeat):
+        user = create_benchmark_user()
+        seed_tracks(user, tracks)
+        # Seeding gives every track the same uploaded_at, spread them so the order is meaningful
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE %s SET uploaded_at = uploaded_at - id * interval '1 second' WHERE user_id = %%s"
+                % Track._meta.db_table, [user.id]
+            )
+            cursor.execute("ANALYZE %s" % Track._meta.db_table)
+
+        queryset = Track.objects.filter(Q(is_service=True)).order_by('-uploaded_at', '-id')
+        for page in pages:
+            offset = page * limit
+            if offset >= tracks:
+                self.stdout.write("page %d is past the %d seeded tracks" % (page, tracks))
+                continue
+            # Cursor of the previous page's last track, as a client walking the pages would hold it
+            if offset:
+                last = queryset[offset - 1]
+                cursor = encode_track_cursor(last.uploaded_at, last.id)
+            else:
+                cursor = None
+
+            offset_best, offset_average = timeit(lambda: list(queryset[offset:offset + limit]), repeat)
+            if cursor is None:
+                keyset_best, keyset_average = timeit(lambda: list(queryset[:limit]), repeat)
+            else:
+                keyset_best, keyset_average = timeit(lambda: list(get_tracks_after(queryset, cursor)[:limit]), repeat)
+            self.stdout.write("page %5d  offset best %7.2f ms avg %7.2f ms  keyset best %7.2f ms avg %7.2f ms" % (
+                page, offset_best, offset_average, keyset_best, keyset_average
+            ))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from radio.models import Track
+from radio.util import search_tracks
+from ._benchmark import Rollback, create_benchmark_user, seed_tracks, timeit
+
+
+TARGET_MILLISECONDS = 10
+
+
+class Command(BaseCommand):
+    help = "Measure ranked keyword search over the trigram indexes. Seeded tracks are rolled back at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=100000)
+        parser.add_argument('--keywords', default="Artist 42,Title 4242,c0ffee,no such track",
+                            help="Comma separated keywords")
+        parser.add_argument('--limit', type=int, default=30)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['tracks'], options['keywords'].split(","), options['limit'], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, tracks, keywords, limit, repeat):
+        user = create_benchmark_user()
+        seed_tracks(user, tracks)
+        with connection.cursor() as cursor:
+            # Some text to search in the description, different for every track
+            cursor.execute(
+                "UPDATE %s SET description = md5(id::text) || ' ' || md5((id * 7)::text) WHERE user_id = %%s"
+                % Track._meta.db_table, [user.id]
+            )
+            cursor.execute("ANALYZE %s" % Track._meta.db_table)
+
+        slow = []
+        for keyword in keywords:
+            queryset = search_tracks(Track.objects.filter(Q(is_service=True)), keyword)
+            rows = queryset.count()
+            best, average = timeit(lambda: list(queryset[:limit]), repeat)
+            if average > TARGET_MILLISECONDS:
+                slow.append(keyword)
+            self.stdout.write("%-16s %6d matches  best %7.2f ms  avg %7.2f ms" % (keyword, rows, best, average))
+
+        if slow:
+            self.stdout.write("over %d ms: %s" % (TARGET_MILLISECONDS, ", ".join(slow)))
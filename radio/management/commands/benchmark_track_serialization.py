@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from radio.models import Track
+from radio.serializers import TrackSerializer, track_values_serializer
+from ._benchmark import Rollback, create_benchmark_user, seed_tracks, timeit
+
+
+class Command(BaseCommand):
+    help = "Measure serializing tracks with TrackSerializer against the .values() fast path. " \
+           "Seeded tracks are rolled back at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tracks', type=int, default=1000)
+        parser.add_argument('--users', type=int, default=10, help="Uploaders the tracks are spread over")
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['tracks'], max(options['users'], 1), options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def run(self, tracks, users, repeat):
+        track_ids = []
+        for index in range(users):
+            count = tracks // users + (1 if index < tracks % users else 0)
+            track_ids += seed_tracks(create_benchmark_user(), count, start=len(track_ids))
+        queryset = Track.objects.filter(id__in=track_ids).order_by('-id')
+
+        paths = (
+            ("TrackSerializer", lambda: TrackSerializer(queryset, many=True).data),
+            ("TrackSerializer select_related", lambda: TrackSerializer(
+                queryset.select_related('user__profile'), many=True
+            ).data),
+            ("values fast path", lambda: track_values_serializer.to_representation(
+                list(track_values_serializer.values(queryset))
+            )),
+        )
+
+        outputs = []
+        for name, serialize in paths:
+            with CaptureQueriesContext(connection) as queries:
+                outputs.append(serialize())
+            best, average = timeit(serialize, repeat)
+            self.stdout.write("%-32s %5d queries  best %8.2f ms  avg %8.2f ms" % (
+                name, len(queries), best, average
+            ))
+
+        if any(output != outputs[0] for output in outputs[1:]):
+            raise CommandError("The fast path output differs from TrackSerializer")
@@ -0,0 +1,126 @@
+import time
+import uuid
+import random
+import asyncio
+import threading
+from aiohttp import web
+from django.core.management.base import BaseCommand, CommandError
+from radio.daemon import (
+    DaemonClient, OutboxWorker, OUTBOX_STATS_KEY, get_outbox_key, get_outbox_stats, send_daemon_command
+)
+from radio.metrics import get_metrics
+from radio.util import (
+    redis_server, get_playlist_key, get_now_playing_key, get_channel_version_key, get_playlist_version_key,
+    get_playlist_snapshot, replace_playlist, insert_playlist, move_playlist, remove_playlist
+)
+from ._mock_daemon import MockDaemon
+
+
+def start_mock_daemon(mock, port):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(mock.create_app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    threading.Thread(target=loop.run_forever, name="mock-daemon", daemon=True).start()
+
+
+def start_outbox_worker(worker):
+    threading.Thread(target=worker.run, name="outbox-worker", daemon=True).start()
+
+
+def get_entry(index):
+    return {
+        "id": index,
+        "location": "/srv/media/sync-check.mp3",
+        "artist": "Sync Check",
+        "title": "Track %d" % index
+    }
+
+
+class Command(BaseCommand):
+    help = "Drive random playlist edits through the delta sync protocol into a stand-in daemon " \
+           "and check that it converges to the playlist in Redis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=9900, help="Port of the stand-in daemon")
+        parser.add_argument('--operations', type=int, default=500)
+        parser.add_argument('--drop-rate', type=float, default=0.02, help="Share of commands lost on the way")
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds between bursts of edits")
+        parser.add_argument('--timeout', type=float, default=60, help="Seconds to wait for the outbox to drain")
+
+    def handle(self, *args, **options):
+        mock = MockDaemon()
+        start_mock_daemon(mock, options['port'])
+        channel = "sync-check-%s" % uuid.uuid4().hex
+        start_outbox_worker(OutboxWorker(
+            [channel], DaemonClient("http://127.0.0.1:%d/" % options['port'], delta_sync=True)
+        ))
+
+        keys = [get_playlist_key(channel), get_now_playing_key(channel),
+                get_channel_version_key(channel), get_playlist_version_key(channel), get_outbox_key(channel)]
+        sent = dropped = 0
+        redelivered = int(redis_server.hget(OUTBOX_STATS_KEY, "redelivered") or 0)
+        try:
+            version, playlist = replace_playlist(channel, [get_entry(-index) for index in range(1, 22)])
+            send_daemon_command(channel, "setlist", playlist, version=version)
+
+            for index in range(options['operations'] + 1):
+                version, op = self.mutate(channel, index)
+                if op is None:
+                    continue
+                # The last edit is always delivered so a dropped one before it shows up as a gap
+                if index < options['operations'] and random.random() < options['drop_rate']:
+                    dropped += 1
+                else:
+                    send_daemon_command(channel, "delta", {"base": version - 1, "version": version, "ops": [op]})
+                    sent += 1
+                if random.random() < 0.1:
+                    time.sleep(options['pause'])
+
+            self.wait_outbox(channel, options['timeout'])
+            version, playlist = get_playlist_snapshot(channel)
+            redelivered = int(redis_server.hget(OUTBOX_STATS_KEY, "redelivered") or 0) - redelivered
+            state = mock.get_channel(channel)
+        finally:
+            redis_server.delete(*keys)
+
+        metrics = get_metrics()
+        self.stdout.write("edits sent %d, dropped %d" % (sent, dropped))
+        self.stdout.write("commands received by daemon %d, coalesced away %d, gaps %d, redelivered %d" % (
+            mock.commands, metrics.get("daemon.coalesced", 0), metrics.get("daemon.gap", 0), redelivered
+        ))
+        if state["version"] != version or state["playlist"] != playlist:
+            raise CommandError("daemon diverged: version %d, expected %d" % (state["version"], version))
+        self.stdout.write("daemon converged at playlist version %d with %d entries" % (version, len(playlist)))
+
+    def wait_outbox(self, channel, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            stats = get_outbox_stats([channel])[channel]
+            if stats["pending"] == 0 and stats["lag"] == 0:
+                return
+            if time.monotonic() > deadline:
+                raise CommandError("outbox not drained after %d seconds: %s" % (timeout, stats))
+            time.sleep(0.1)
+
+    def mutate(self, channel, index):
+        """
+        :return: (playlist version, delta op), op is None if the edit was rejected
+        """
+        length = redis_server.llen(get_playlist_key(channel))
+        operation = random.random()
+        try:
+            if operation < 0.4 or length < 2:
+                at = random.randint(0, length)
+                version, _ = insert_playlist(channel, at, get_entry(index))
+                return version, {"op": "insert", "index": at, "entry": get_entry(index)}
+            elif operation < 0.75:
+                from_index, to_index = random.randrange(length), random.randrange(length)
+                version, _ = move_playlist(channel, from_index, to_index)
+                return version, {"op": "move", "from": from_index, "to": to_index}
+            else:
+                at = random.randrange(length)
+                version, _ = remove_playlist(channel, at)
+                return version, {"op": "remove", "index": at}
+        except IndexError:
+            return None, None
@@ -0,0 +1,75 @@
+from datetime import datetime
+from dateutil.tz import tzlocal
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from radio.models import DEFAULT_CHANNEL, Track, get_channel_filter
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN " + sql, params)
+        return "\n".join(row[0] for row in cursor.fetchall())
+
+
+def get_query_plans():
+    """
+    :return: list of (name, queryset, index name the plan must use)
+    """
+    now = datetime.now(tz=tzlocal())
+    return [
+        (
+            "track channel membership",
+            Track.objects.filter(get_channel_filter(DEFAULT_CHANNEL)).only('id'),
+            "radio_track_channel_gin",
+        ),
+        (
+            "soft deleted tracks to purge",
+            Track.all_objects.filter(deleted_at__isnull=False).order_by('deleted_at').only('id', 'location'),
+            "radio_track_deleted_at",
+        ),
+        (
+            "track list keyset page",
+            Track.objects.filter(
+                Q(uploaded_at__lte=now) & (Q(uploaded_at__lt=now) | Q(id__lt=1))
+            ).order_by('-uploaded_at', '-id').only('id')[:30],
+            "radio_track_uploaded_id",
+        ),
+        (
+            "track title search",
+            Track.objects.filter(title__icontains="trance").only('id'),
+            "radio_track_title_trgm",
+        ),
+        (
+            "track artist search",
+            Track.objects.filter(artist__icontains="trance").only('id'),
+            "radio_track_artist_trgm",
+        ),
+        (
+            "track description search",
+            Track.objects.filter(description__icontains="trance").only('id'),
+            "radio_track_description_trgm",
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the hot radio queries and fail if they do not use their index. " \
+           "Sequential scans are disabled so the check does not depend on table size"
+
+    def handle(self, *args, **options):
+        failed = []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            for name, queryset, index_name in get_query_plans():
+                plan = explain(queryset)
+                if index_name in plan:
+                    self.stdout.write("OK   %s uses %s" % (name, index_name))
+                else:
+                    failed.append(name)
+                    self.stdout.write("FAIL %s does not use %s\n%s" % (name, index_name, plan))
+
+        if failed:
+            raise CommandError("Query plan check failed: %s" % ", ".join(failed))
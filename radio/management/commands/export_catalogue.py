@@ -0,0 +1,51 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from radio.models import CHANNEL
+from radio.export import (
+    parse_export_date, filter_tracks, filter_play_history, stream_export,
+    TRACK_EXPORT_FIELDS, PLAY_HISTORY_EXPORT_FIELDS, EXPORT_FORMATS, EXPORT_NDJSON, EXPORT_CHUNK_SIZE
+)
+
+
+EXPORTS = {
+    "tracks": (filter_tracks, TRACK_EXPORT_FIELDS),
+    "play_history": (filter_play_history, PLAY_HISTORY_EXPORT_FIELDS),
+}
+
+
+def parse_date_option(value):
+    try:
+        return parse_export_date(value)
+    except ValueError as e:
+        raise CommandError(str(e))
+
+
+class Command(BaseCommand):
+    help = "Stream tracks or play history as NDJSON or CSV through a server-side cursor"
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS.keys()))
+        parser.add_argument('--format', choices=sorted(EXPORT_FORMATS.keys()), default=EXPORT_NDJSON)
+        parser.add_argument('--channel', choices=[channel for channel, name in CHANNEL])
+        parser.add_argument('--from', dest='date_from', help="ISO 8601 date or datetime, inclusive")
+        parser.add_argument('--to', dest='date_to', help="ISO 8601 date or datetime, exclusive")
+        parser.add_argument('--uploader', type=int, help="User id of the uploader")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+        parser.add_argument('--output', help="File to write, standard output if not given")
+
+    def handle(self, *args, **options):
+        filter_rows, fields = EXPORTS[options['export']]
+        rows = filter_rows(
+            channel=options['channel'],
+            date_from=parse_date_option(options['date_from']) if options['date_from'] else None,
+            date_to=parse_date_option(options['date_to']) if options['date_to'] else None,
+            uploader=options['uploader'],
+        )
+        lines = stream_export(rows, fields, options['format'], options['chunk_size'])
+
+        if options['output']:
+            # The csv module writes its own line endings
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                output.writelines(lines)
+        else:
+            sys.stdout.writelines(lines)
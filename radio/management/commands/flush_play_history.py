@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from radio.history import PLAY_HISTORY_BATCH_SIZE, PlayHistoryFlusher
+
+
+class Command(BaseCommand):
+    help = "Insert the plays buffered by on_play into PlayHistory in batches while this replica holds the lease"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PLAY_HISTORY_BATCH_SIZE)
+        parser.add_argument('--delay', type=float, default=None,
+                            help="Longest seconds a play is buffered, PLAY_HISTORY_FLUSH_DELAY by default")
+        parser.add_argument('--once', action='store_true', help="Flush what is buffered now and exit")
+
+    def handle(self, *args, **options):
+        flusher = PlayHistoryFlusher(options['batch_size'], options['delay'])
+        if options['once']:
+            self.stdout.write("%d plays flushed" % flusher.drain())
+        else:
+            flusher.run()
@@ -0,0 +1,254 @@
+import json
+import time
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from radio.daemon import PLAYLIST_VERSION_HEADER, build_daemon_command, get_outbox_key
+from radio.history import PlayHistoryFlusher
+from radio.index import get_eligible_index_key, index_track
+from radio.models import CHANNEL, SERVICE_CHANNEL, PlayHistory, Track
+from radio.util import (
+    SPARE_KEY, redis_server, get_playlist_key, get_now_playing_key, get_channel_version_key,
+    get_playlist_version_key, get_playlist_snapshot
+)
+from ._benchmark import create_benchmark_user, seed_tracks, percentile
+from ._mock_daemon import MockDaemon
+
+
+CALLBACKS = ("on_startup", "on_play", "on_stop")
+CALLBACK_URL = "/v1/radio/callback/%s/%s"
+# Statements a callback may never exceed, whatever the options
+QUERY_BUDGET = {
+    "on_play": 1,
+}
+
+
+@contextmanager
+def simulated_channels(channels):
+    """
+    Register channels as service channels of this process only, for the length of the run
+    """
+    CHANNEL.extend((channel, channel) for channel in channels)
+    SERVICE_CHANNEL.extend(channels)
+    try:
+        yield
+    finally:
+        for channel in channels:
+            CHANNEL.remove((channel, channel))
+            SERVICE_CHANNEL.remove(channel)
+
+
+class CallbackStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {name: [] for name in CALLBACKS}
+        self.errors = Counter()
+        self.resyncs = 0
+
+    def record(self, name, elapsed, queries, redis_calls, ok):
+        with self.lock:
+            self.samples[name].append((elapsed, queries, redis_calls))
+            if not ok:
+                self.errors[name] += 1
+
+
+class SimulatedPlayer(threading.Thread):
+    """
+    Plays one channel as the music daemon does: takes the head of its queue, reports on_play,
+    waits the track out on the accelerated clock and asks on_stop for the next track.
+    The played track leaves the playlist through on_play only, the player never removes it itself
+    """
+    def __init__(self, channel, daemon, stats, plays, track_seconds, speed):
+        super(SimulatedPlayer, self).__init__(name="player-%s" % channel, daemon=True)
+        self.channel = channel
+        self.daemon = daemon
+        self.stats = stats
+        self.plays = plays
+        self.track_seconds = track_seconds
+        self.speed = speed
+        self.error = None
+
+    def call(self, name, data=None):
+        client = Client()
+        path = CALLBACK_URL % (name, self.channel)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            if data is None:
+                response = client.get(path)
+            else:
+                response = client.post(path, json.dumps(data), content_type='application/json')
+            elapsed = (time.perf_counter() - started) * 1000
+        self.stats.record(
+            name, elapsed, len(queries), int(response.get('X-Redis-Calls', 0)), response.status_code == 200
+        )
+        if response.status_code != 200:
+            raise CommandError("%s of %s answered %d" % (name, self.channel, response.status_code))
+        return response
+
+    def apply(self, version, op):
+        response = self.daemon.handle_command(build_daemon_command(
+            self.channel, "delta", {"base": version - 1, "version": version, "ops": [op]}
+        ))
+        if response["status"] == "gap":
+            self.resync()
+
+    def resync(self):
+        with self.stats.lock:
+            self.stats.resyncs += 1
+        version, playlist = get_playlist_snapshot(self.channel)
+        self.daemon.handle_command(build_daemon_command(self.channel, "setlist", playlist, version=version))
+
+    def startup(self):
+        response = self.call("on_startup")
+        self.daemon.handle_command(build_daemon_command(
+            self.channel, "setlist", json.loads(response.content),
+            version=int(response.get(PLAYLIST_VERSION_HEADER, 0))
+        ))
+
+    def run(self):
+        try:
+            self.startup()
+            for play in range(self.plays):
+                state = self.daemon.get_channel(self.channel)
+                if not state["playlist"]:
+                    raise CommandError("queue of %s ran empty" % self.channel)
+
+                # The daemon takes the track it starts off its queue, on_play takes it off the playlist
+                entry = state["playlist"][0]
+                response = self.call("on_play", entry)
+                if PLAYLIST_VERSION_HEADER not in response:
+                    raise CommandError("on_play of %s left track %s at the head of the playlist" % (
+                        self.channel, entry["id"]
+                    ))
+                self.apply(int(response[PLAYLIST_VERSION_HEADER]), {"op": "remove", "index": 0})
+
+                time.sleep(self.track_seconds * random.uniform(0.8, 1.2) / self.speed)
+
+                response = self.call("on_stop", {})
+                new_track = json.loads(response.content)
+                if new_track is None:
+                    continue
+                if PLAYLIST_VERSION_HEADER in response:
+                    self.apply(int(response[PLAYLIST_VERSION_HEADER]), {
+                        "op": "insert", "index": len(self.daemon.get_channel(self.channel)["playlist"]),
+                        "entry": new_track
+                    })
+                else:
+                    self.resync()
+        except Exception as e:
+            self.error = e
+        finally:
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = "Run the on_startup, on_play and on_stop loop of a stand-in music daemon for many channels " \
+           "at an accelerated clock and report latency, DB queries and Redis calls per callback. " \
+           "Needs local Postgres and Redis only, seeded tracks and keys are removed at the end"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channels', type=int, default=8, help="Simulated channels, one player each")
+        parser.add_argument('--plays', type=int, default=50, help="Tracks played per channel")
+        parser.add_argument('--tracks', type=int, default=2000, help="Tracks seeded per channel")
+        parser.add_argument('--track-seconds', type=float, default=300, help="Simulated length of a track")
+        parser.add_argument('--speed', type=float, default=600, help="Simulated seconds per wall clock second")
+        parser.add_argument('--max-p99', type=float, default=None, help="Fail if a callback p99 exceeds milliseconds")
+        parser.add_argument('--max-queries', type=int, default=None, help="Fail if a callback exceeds DB queries")
+
+    def handle(self, *args, **options):
+        channels = ["load-%d" % index for index in range(options['channels'])]
+        stats = CallbackStats()
+        daemon = MockDaemon()
+
+        with simulated_channels(channels), override_settings(ALLOWED_HOSTS=['testserver'], RADIO_DEBUG_HEADERS=True):
+            user = create_benchmark_user()
+            try:
+                self.seed(user, channels, options['tracks'])
+                players = [
+                    SimulatedPlayer(
+                        channel, daemon, stats, options['plays'], options['track_seconds'], options['speed']
+                    ) for channel in channels
+                ]
+                started = time.perf_counter()
+                for player in players:
+                    player.start()
+                for player in players:
+                    player.join()
+                elapsed = time.perf_counter() - started
+                diverged = [channel for channel in channels if self.diverged(daemon, channel)]
+            finally:
+                self.cleanup(user, channels)
+
+        errors = [player.error for player in players if player.error is not None]
+        plays = len(stats.samples["on_play"])
+        self.stdout.write("%d channels played %d tracks in %.1f s, %.1f simulated hours" % (
+            len(channels), plays, elapsed, plays * options['track_seconds'] / 3600.0
+        ))
+        self.stdout.write("daemon commands %d, gaps %d, resyncs %d" % (daemon.commands, daemon.gaps, stats.resyncs))
+
+        failures = ["%s: %s" % (type(error).__name__, error) for error in errors[:3]]
+        for name in CALLBACKS:
+            samples = stats.samples[name]
+            latencies = [sample[0] for sample in samples]
+            queries = [sample[1] for sample in samples]
+            redis_calls = [sample[2] for sample in samples]
+            p99 = percentile(latencies, 0.99)
+            self.stdout.write(
+                "%-10s %5d calls  p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms  "
+                "queries avg %.1f max %d  redis avg %.1f max %d  errors %d" % (
+                    name, len(samples), percentile(latencies, 0.5), p99, max(latencies or [0.0]),
+                    sum(queries) / max(len(queries), 1), max(queries or [0]),
+                    sum(redis_calls) / max(len(redis_calls), 1), max(redis_calls or [0]), stats.errors[name]
+                )
+            )
+            if options['max_p99'] is not None and p99 > options['max_p99']:
+                failures.append("%s p99 %.1f ms over %.1f ms" % (name, p99, options['max_p99']))
+            if options['max_queries'] is not None and max(queries or [0]) > options['max_queries']:
+                failures.append("%s ran %d queries, over %d" % (name, max(queries), options['max_queries']))
+            if name in QUERY_BUDGET and max(queries or [0]) > QUERY_BUDGET[name]:
+                failures.append("%s ran %d queries, over its budget of %d" % (
+                    name, max(queries), QUERY_BUDGET[name]
+                ))
+
+        if diverged:
+            failures.append("daemon queue diverged from Redis on %s" % ", ".join(diverged))
+        if failures:
+            raise CommandError("; ".join(failures))
+
+    def seed(self, user, channels, tracks):
+        for channel in channels:
+            seed_tracks(user, tracks, channel)
+
+        # As the rebuild_eligible_index command would, so picks take the same path as in production
+        pipe = redis_server.pipeline(transaction=False)
+        for index, track in enumerate(Track.objects.filter(user=user).iterator(chunk_size=2000)):
+            index_track(track, pipe)
+            if index % 1000 == 999:
+                pipe.execute()
+        pipe.execute()
+
+    def diverged(self, daemon, channel):
+        version, playlist = get_playlist_snapshot(channel)
+        state = daemon.get_channel(channel)
+        return state["version"] != version or state["playlist"] != playlist
+
+    def cleanup(self, user, channels):
+        # Flushed here so a running flush_play_history does not insert them after the delete
+        PlayHistoryFlusher().drain()
+        PlayHistory.objects.filter(channel__in=channels).delete()
+        Track.objects.filter(user=user).delete()
+        user.delete()
+
+        keys = []
+        for channel in channels:
+            keys += [
+                get_playlist_key(channel), get_now_playing_key(channel), get_channel_version_key(channel),
+                get_playlist_version_key(channel), get_outbox_key(channel), get_eligible_index_key(channel),
+                SPARE_KEY.format(channel)
+            ]
+        redis_server.delete(*keys)
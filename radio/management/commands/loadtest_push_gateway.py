@@ -0,0 +1,102 @@
+import time
+import asyncio
+import resource
+import aiohttp
+from django.core.management.base import BaseCommand, CommandError
+from radio.models import SERVICE_CHANNEL
+from radio.util import redis_server, get_channel_version_key, publish_channel_event
+from ._benchmark import percentile
+
+
+CONNECT_BATCH_SIZE = 500
+# Never a service channel, so real listeners, ETags and caches are left alone
+LOADTEST_CHANNEL = "loadtest"
+
+
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+class Command(BaseCommand):
+    help = "Hold many concurrent subscribers on the push gateway and measure event delivery latency. " \
+           "The gateway must serve the channel: run_push_gateway --extra-channel %s" % LOADTEST_CHANNEL
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8091')
+        parser.add_argument('--channel', default=LOADTEST_CHANNEL, help="Any channel but a service channel")
+        parser.add_argument('--subscribers', type=int, default=5000)
+        parser.add_argument('--events', type=int, default=10)
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds between events")
+
+    def handle(self, *args, **options):
+        if options['channel'] in SERVICE_CHANNEL:
+            raise CommandError("%s is a service channel, its events would reach real listeners" % options['channel'])
+
+        subscribers = options['subscribers']
+        limit = raise_open_file_limit()
+        if limit < subscribers + 100:
+            raise CommandError("Open file limit %d is too low for %d subscribers" % (limit, subscribers))
+
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.run(
+                "%s/events/%s" % (options['url'].rstrip('/'), options['channel']),
+                options['channel'], subscribers, options['events'], options['interval']
+            ))
+        finally:
+            redis_server.delete(get_channel_version_key(options['channel']))
+
+    async def run(self, url, channel, subscribers, events, interval):
+        connected = []
+        received = {}
+
+        async def subscribe(session):
+            async with session.get(url) as response:
+                connected.append(time.perf_counter())
+                async for line in response.content:
+                    if line.startswith(b"id: "):
+                        received.setdefault(int(line[4:]), []).append(time.perf_counter())
+
+        connector = aiohttp.TCPConnector(limit=0)
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            started = time.perf_counter()
+            tasks = []
+            for offset in range(0, subscribers, CONNECT_BATCH_SIZE):
+                for _ in range(min(CONNECT_BATCH_SIZE, subscribers - offset)):
+                    tasks.append(asyncio.ensure_future(subscribe(session)))
+                await asyncio.sleep(0.1)
+            while len(connected) < subscribers:
+                failed = [task for task in tasks if task.done()]
+                if failed:
+                    raise CommandError("%d subscribers disconnected: %r" % (len(failed), failed[0].exception()))
+                await asyncio.sleep(0.1)
+            self.stdout.write("%d subscribers connected in %.1f s" % (subscribers, time.perf_counter() - started))
+
+            sent = {}
+            version_key = get_channel_version_key(channel)
+            for _ in range(events):
+                version = redis_server.incr(version_key)
+                sent[version] = time.perf_counter()
+                publish_channel_event(channel, version)
+                await asyncio.sleep(interval)
+            await asyncio.sleep(2)
+
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        latencies = []
+        delivered = 0
+        for version, sent_at in sent.items():
+            times = received.get(version, [])
+            delivered += len(times)
+            latencies += [(received_at - sent_at) * 1000 for received_at in times]
+
+        self.stdout.write("delivered %d/%d events" % (delivered, subscribers * events))
+        self.stdout.write("latency p50 %.1f ms  p99 %.1f ms  max %.1f ms" % (
+            percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies or [0.0])
+        ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from radio.models import CHANNEL
+from radio.util import migrate_redis_data, migrate_pending_remove
+
+
+class Command(BaseCommand):
+    help = "Convert legacy JSON channel documents and pending_remove in Redis to native data structures"
+
+    def handle(self, *args, **options):
+        for channel, _ in CHANNEL:
+            if migrate_redis_data(channel):
+                self.stdout.write("%s: migrated" % channel)
+            else:
+                self.stdout.write("%s: nothing to migrate" % channel)
+        self.stdout.write("pending_remove: %d tracks migrated" % migrate_pending_remove())
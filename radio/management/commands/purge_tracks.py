@@ -0,0 +1,55 @@
+import time
+from django.core.management.base import BaseCommand
+from redis.exceptions import RedisError
+from radio.lease import Lease, get_consumer_name
+from radio.purge import (
+    PURGE_BATCH_SIZE, PURGE_WORKERS, PURGE_INTERVAL, PURGE_LEASE, PURGE_LEASE_TTL, purge_tracks
+)
+
+
+class Command(BaseCommand):
+    help = "Remove soft deleted tracks from playlists, storage and the database, " \
+           "and delete tracks reserved pending remove once they stopped playing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE)
+        parser.add_argument('--workers', type=int, default=PURGE_WORKERS, help="Parallel storage deletes")
+        parser.add_argument('--interval', type=float, default=PURGE_INTERVAL, help="Seconds between idle runs")
+        parser.add_argument('--once', action='store_true', help="Purge everything deleted now and exit")
+
+    def handle(self, *args, **options):
+        lease = Lease(PURGE_LEASE, get_consumer_name(), PURGE_LEASE_TTL)
+        try:
+            self.purge(lease, options)
+        finally:
+            try:
+                lease.release()
+            except RedisError:
+                pass
+
+    def purge(self, lease, options):
+        while True:
+            try:
+                lease.hold()
+            except RedisError as e:
+                print('purge lease error: {}'.format(e))
+                lease.held = False
+            if not lease.held:
+                if options['once']:
+                    self.stdout.write("Another replica is purging")
+                    return
+                # Another replica purges
+                time.sleep(options['interval'])
+                continue
+
+            try:
+                purged, failed = purge_tracks(options['batch_size'], options['workers'])
+            except Exception as e:
+                print('purge error: {}'.format(e))
+                purged, failed = 0, 0
+            if purged or failed:
+                self.stdout.write("%d tracks purged, %d failed" % (purged, failed))
+            if options['once'] and purged < options['batch_size']:
+                return
+            if purged < options['batch_size']:
+                time.sleep(options['interval'])
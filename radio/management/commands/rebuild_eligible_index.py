@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from radio.index import rebuild_eligible_index, rebuild_harmonic_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-channel eligible track index and harmonic buckets in Redis from the Track table"
+
+    def handle(self, *args, **options):
+        result = rebuild_eligible_index()
+        for channel, count in result.items():
+            self.stdout.write("%s: %d tracks indexed" % (channel, count))
+        self.stdout.write("harmonic: %d tracks indexed" % rebuild_harmonic_index())
@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from radio.daemon import DaemonClient, OutboxWorker
+from radio.models import SERVICE_CHANNEL
+
+
+class Command(BaseCommand):
+    help = "Deliver the daemon command outbox of every service channel whose lease this replica holds"
+
+    def handle(self, *args, **options):
+        OutboxWorker(SERVICE_CHANNEL, DaemonClient(settings.MUSICDAEMON_URL)).run()
@@ -0,0 +1,14 @@
+from aiohttp import web
+from django.core.management.base import BaseCommand
+from ._mock_daemon import MockDaemon
+
+
+class Command(BaseCommand):
+    help = "Run a stand-in music daemon which applies setlist and delta commands and serves its state on /state"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9000)
+
+    def handle(self, *args, **options):
+        web.run_app(MockDaemon().create_app(), host=options['host'], port=options['port'])
@@ -0,0 +1,16 @@
+from aiohttp import web
+from django.core.management.base import BaseCommand
+from radio.push_gateway import create_app
+
+
+class Command(BaseCommand):
+    help = "Serve channel state changes as Server-Sent Events on /events/<channel>"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8091)
+        parser.add_argument('--extra-channel', action='append', default=[], dest='extra_channels',
+                            help="Also serve this channel, e.g. the one of loadtest_push_gateway. Repeatable")
+
+    def handle(self, *args, **options):
+        web.run_app(create_app(options['extra_channels']), host=options['host'], port=options['port'])
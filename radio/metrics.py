@@ -0,0 +1,49 @@
+"""
+In-process counters of the radio state layer.
+Every uWSGI worker keeps its own, so a reading covers the worker which served it
+"""
+import threading
+
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    with _lock:
+        count, total, maximum = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+
+
+def get_metrics():
+    """
+    :return: dict of counter name and value. Timings are reported as count, avg_ms and max_ms
+    """
+    with _lock:
+        metrics = dict(_counters)
+        for name, (count, total, maximum) in _timings.items():
+            metrics[name] = {
+                "count": count,
+                "avg_ms": total * 1000 / count if count else 0.0,
+                "max_ms": maximum * 1000,
+            }
+    return metrics
+
+
+def reset_metrics(*names):
+    """
+    Reset the given metrics, or every metric if no name is given
+    """
+    with _lock:
+        if not names:
+            _counters.clear()
+            _timings.clear()
+        for name in names:
+            _counters.pop(name, None)
+            _timings.pop(name, None)
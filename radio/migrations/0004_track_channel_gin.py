@@ -0,0 +1,16 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0003_auto_20200511_0221'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='track',
+            index=GinIndex(fields=['channel'], name='radio_track_channel_gin'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0004_track_channel_gin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playhistory',
+            name='event_id',
+            field=models.CharField(blank=True, editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
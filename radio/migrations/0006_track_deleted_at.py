@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0005_playhistory_event_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='track',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, default=None, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='track',
+            index=models.Index(
+                condition=models.Q(deleted_at__isnull=False), fields=['deleted_at'], name='radio_track_deleted_at'
+            ),
+        ),
+    ]
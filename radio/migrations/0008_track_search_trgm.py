@@ -0,0 +1,26 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0007_track_uploaded_id'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='track',
+            index=GinIndex(fields=['title'], name='radio_track_title_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='track',
+            index=GinIndex(fields=['artist'], name='radio_track_artist_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='track',
+            index=GinIndex(fields=['description'], name='radio_track_description_trgm', opclasses=['gin_trgm_ops']),
+        ),
+    ]
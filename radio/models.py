@@ -1,7 +1,9 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models import Q
 from django.utils.translation import ugettext_lazy as _
 from django_utils import multi_db_ralation
 
@@ -31,10 +33,23 @@ SUPPORT_FORMAT = [
 ]
 
 
+def get_channel_filter(channel):
+    """
+    Array containment on Track.channel. Matches whole channel names only and can use the GIN index
+    """
+    return Q(channel__contains=[channel])
+
+
 class ModelQuerySet(multi_db_ralation.ExternalDbQuerySetMixin, models.QuerySet):
     pass
 
 
+class TrackManager(models.Manager.from_queryset(queryset_class=ModelQuerySet)):
+    def get_queryset(self):
+        # Soft deleted tracks only wait for purge_tracks, nothing else may see them
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
+
 class Track(models.Model):
     user = models.ForeignKey(
         get_user_model(), on_delete=models.CASCADE, null=False, blank=False, editable=False
@@ -69,14 +84,27 @@ class Track(models.Model):
     uploaded_at = models.DateTimeField(auto_now_add=True, editable=False)
     updated_at = models.DateTimeField(auto_now=True, editable=False)
     last_played_at = models.DateTimeField(null=True, blank=True, editable=False)
+    deleted_at = models.DateTimeField(null=True, blank=True, default=None, editable=False)
 
-    objects = models.Manager.from_queryset(queryset_class=ModelQuerySet)()
+    objects = TrackManager()
+    # Includes soft deleted tracks
+    all_objects = models.Manager.from_queryset(queryset_class=ModelQuerySet)()
 
     class Meta:
         app_label = 'radio'
         external_db_fields = ['user']
         verbose_name = 'Music'
         verbose_name_plural = 'Music'
+        indexes = [
+            GinIndex(fields=['channel'], name='radio_track_channel_gin'),
+            models.Index(fields=['deleted_at'], name='radio_track_deleted_at', condition=Q(deleted_at__isnull=False)),
+            # Keyset pagination of the track list, scanned backwards for the newest first order
+            models.Index(fields=['uploaded_at', 'id'], name='radio_track_uploaded_id'),
+            # Keyword search, ILIKE '%keyword%' on each column
+            GinIndex(fields=['title'], name='radio_track_title_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['artist'], name='radio_track_artist_trgm', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['description'], name='radio_track_description_trgm', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return "%s - %s" % (self.artist, self.title)
@@ -118,6 +146,9 @@ class PlayHistory(models.Model):
 
     played_at = models.DateTimeField(null=False, blank=False, editable=False)
 
+    # Entry id of the buffered play, makes a repeated flush insert nothing. Null for rows written before
+    event_id = models.CharField(null=True, blank=True, max_length=32, unique=True, editable=False)
+
     class Meta:
         app_label = 'radio'
         verbose_name = 'Play History'
@@ -0,0 +1,77 @@
+"""
+Background removal of deleted tracks.
+
+Deleting a track only sets Track.deleted_at, which hides it at once. purge_tracks takes a batch
+of soft deleted tracks, strips them from every playlist in one script call, deletes their files
+in parallel and then their rows. A file which could not be deleted keeps its row for the next run.
+Tracks reserved pending remove are soft deleted here once they stopped playing.
+Every replica may run the purge loop, only the holder of the PURGE_LEASE lease purges.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from django.db import transaction
+from django_utils import storage
+from google.api_core.exceptions import NotFound
+from . import metrics
+from .daemon import send_setlist
+from .util import (
+    get_releasable_pending_remove, release_pending_remove, are_pending_remove,
+    soft_delete_tracks, strip_tracks_from_playlists, get_playlist_snapshot
+)
+
+
+PURGE_BATCH_SIZE = 100
+PURGE_WORKERS = 8
+PURGE_INTERVAL = 5
+PURGE_LEASE = "purge"
+# Renewed between batches only, so long enough for a batch of slow storage deletes
+PURGE_LEASE_TTL = 300000
+
+
+def delete_track_file(location):
+    try:
+        storage_driver = 'gcs'
+        storage.delete_file('music', location.split("/")[-1], storage_driver)
+    except NotFound:
+        pass
+
+
+def purge_tracks(batch_size=PURGE_BATCH_SIZE, workers=PURGE_WORKERS):
+    """
+    :return: (number of purged tracks, number of tracks whose file could not be deleted)
+    """
+    from .models import (
+        Track
+    )
+
+    releasable = get_releasable_pending_remove()
+    if releasable:
+        with transaction.atomic():
+            # Checked again, a reservation cancelled meanwhile keeps its track
+            released = list(are_pending_remove(releasable))
+            soft_delete_tracks(Track.objects.filter(id__in=released))
+            transaction.on_commit(lambda: release_pending_remove(released))
+
+    tracks = list(
+        Track.all_objects.filter(deleted_at__isnull=False).order_by('deleted_at').only('id', 'location')[:batch_size]
+    )
+    if not tracks:
+        return 0, 0
+
+    for channel in strip_tracks_from_playlists([track.id for track in tracks]):
+        version, playlist = get_playlist_snapshot(channel)
+        send_setlist(channel, version, playlist)
+
+    purged_ids = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(track.id, executor.submit(delete_track_file, track.location)) for track in tracks]
+        for track_id, future in futures:
+            try:
+                future.result()
+                purged_ids.append(track_id)
+            except Exception as e:
+                print('storage error: {}'.format(e))
+
+    Track.all_objects.filter(id__in=purged_ids).delete()
+    metrics.incr("purge.purged", len(purged_ids))
+    metrics.incr("purge.failed", len(tracks) - len(purged_ids))
+    return len(purged_ids), len(tracks) - len(purged_ids)
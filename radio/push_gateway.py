@@ -0,0 +1,166 @@
+"""
+Server-Sent Events gateway streaming channel state to listeners instead of polling.
+
+One process holds every connection on an asyncio loop. A thread subscribed to the
+channel events wakes the loop, the changed channel is read once from Redis and the
+same encoded event is written to all of its subscribers. Subscribers only ever need
+the latest state, so a slow one skips intermediate versions instead of buffering them.
+"""
+import json
+import time
+import asyncio
+import threading
+from aiohttp import web
+from .models import SERVICE_CHANNEL
+from .scripts import CHANNEL_EVENTS
+from .util import redis_server, fetch_redis_data
+
+
+HEARTBEAT_INTERVAL = 15
+RETRY_MILLISECONDS = 3000
+
+
+def encode_event(channel, redis_data):
+    payload = json.dumps({
+        "channel": channel,
+        "version": redis_data["version"],
+        "now_playing": redis_data["now_playing"],
+        "playlist": redis_data["playlist"],
+    }, ensure_ascii=False)
+    return ("id: %d\nevent: channel\ndata: %s\n\n" % (redis_data["version"], payload)).encode('utf-8')
+
+
+class Subscriber(object):
+    def __init__(self):
+        self.event = None
+        self.ready = asyncio.Event()
+
+    def push(self, event):
+        # Replace anything not yet written, the latest state is all a listener needs
+        self.event = event
+        self.ready.set()
+
+    async def pop(self, timeout):
+        await asyncio.wait_for(self.ready.wait(), timeout)
+        self.ready.clear()
+        event, self.event = self.event, None
+        return event
+
+
+class PushGateway(object):
+    def __init__(self, extra_channels=()):
+        """
+        :param extra_channels: channels served besides the service channels, e.g. for a load test
+        """
+        self.loop = None
+        self.subscribers = {channel: set() for channel in list(SERVICE_CHANNEL) + list(extra_channels)}
+        self.events = {}
+        self.versions = {}
+        self.refreshing = set()
+        self.stale = set()
+
+    async def start(self, app):
+        self.loop = asyncio.get_event_loop()
+        threading.Thread(target=self.listen, name="push-gateway", daemon=True).start()
+
+    async def refresh(self, channel):
+        """
+        Read channel once and fan it out. Events arriving meanwhile trigger a single re-read
+        """
+        if channel in self.refreshing:
+            self.stale.add(channel)
+            return
+        self.refreshing.add(channel)
+        try:
+            while True:
+                self.stale.discard(channel)
+                redis_data = (await self.loop.run_in_executor(None, fetch_redis_data, [channel]))[0][channel]
+                if redis_data["version"] != self.versions.get(channel):
+                    event = encode_event(channel, redis_data)
+                    self.events[channel] = event
+                    self.versions[channel] = redis_data["version"]
+                    for subscriber in self.subscribers[channel]:
+                        subscriber.push(event)
+                if channel not in self.stale:
+                    break
+        except Exception as e:
+            print('push gateway refresh error: {}'.format(e))
+        finally:
+            self.refreshing.discard(channel)
+
+    def on_channel_event(self, channel):
+        if channel in self.subscribers:
+            self.loop.create_task(self.refresh(channel))
+
+    def listen(self):
+        """
+        Blocking subscriber loop, run in its own thread
+        """
+        while True:
+            pubsub = redis_server.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(CHANNEL_EVENTS)
+                # Anything may have changed while disconnected
+                for channel in list(self.subscribers.keys()):
+                    self.loop.call_soon_threadsafe(self.on_channel_event, channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        channel = json.loads(message["data"])["channel"]
+                        self.loop.call_soon_threadsafe(self.on_channel_event, channel)
+            except Exception as e:
+                print('redis pubsub error: {}'.format(e))
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+    async def handle_events(self, request):
+        channel = request.match_info["channel"]
+        if channel not in self.subscribers:
+            raise web.HTTPNotFound()
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Access-Control-Allow-Origin": "*",
+        })
+        await response.prepare(request)
+        await response.write(("retry: %d\n\n" % RETRY_MILLISECONDS).encode('utf-8'))
+
+        subscriber = Subscriber()
+        event = self.events.get(channel)
+        if event is not None and request.headers.get("Last-Event-ID") != str(self.versions[channel]):
+            subscriber.push(event)
+
+        self.subscribers[channel].add(subscriber)
+        try:
+            while True:
+                try:
+                    event = await subscriber.pop(HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    event = b": ping\n\n"
+                await response.write(event)
+        except ConnectionResetError:
+            pass
+        finally:
+            self.subscribers[channel].discard(subscriber)
+        return response
+
+    async def handle_stats(self, request):
+        return web.json_response({
+            channel: {
+                "subscribers": len(subscribers),
+                "version": self.versions.get(channel),
+            } for channel, subscribers in self.subscribers.items()
+        })
+
+
+def create_app(extra_channels=()):
+    gateway = PushGateway(extra_channels)
+
+    app = web.Application()
+    app.on_startup.append(gateway.start)
+    app.router.add_get("/events/{channel}", gateway.handle_events)
+    app.router.add_get("/stats", gateway.handle_stats)
+    return app
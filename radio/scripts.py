@@ -0,0 +1,215 @@
+"""
+Lua sources of the playlist mutations.
+
+Playlist scripts take KEYS[1] = playlist list, KEYS[2] = playlist version counter,
+KEYS[3] = channel version counter and ARGV[1] = channel name, and reply the playlist version
+followed by the raw playlist entries, so each mutation is a single round-trip.
+A change bumps both counters by one and is published to CHANNEL_EVENTS
+as {"channel": name, "version": channel version}.
+Indexes follow Python semantics and out of range ones fail with PLAYLIST_INDEX_ERROR.
+"""
+
+PLAYLIST_INDEX_ERROR = "playlist index out of range"
+CHANNEL_EVENTS = "radio:channel"
+
+_HEADER = """
+local function load(key)
+    return redis.call('LRANGE', key, 0, -1)
+end
+
+local function store(key, entries)
+    redis.call('DEL', key)
+    for _, entry in ipairs(entries) do
+        redis.call('RPUSH', key, entry)
+    end
+end
+
+local function position(index, length)
+    index = tonumber(index)
+    if index == nil or index < -length or index >= length then
+        return nil
+    end
+    if index < 0 then
+        index = index + length
+    end
+    return index + 1
+end
+
+local function entry_id(entry)
+    return tostring(cjson.decode(entry)['id'])
+end
+
+local function publish(channel, version)
+    redis.call('PUBLISH', '%s', cjson.encode({channel = channel, version = version}))
+end
+
+local function bump(playlist_version_key, channel_version_key, channel)
+    publish(channel, redis.call('INCR', channel_version_key))
+    return redis.call('INCR', playlist_version_key)
+end
+
+local function reply(playlist_key, playlist_version_key, channel_version_key, channel, changed)
+    local version
+    if changed then
+        version = bump(playlist_version_key, channel_version_key, channel)
+    else
+        version = tonumber(redis.call('GET', playlist_version_key) or 0)
+    end
+    local result = load(playlist_key)
+    table.insert(result, 1, version)
+    return result
+end
+
+local function index_error()
+    return redis.error_reply('ERR %s')
+end
+""" % (CHANNEL_EVENTS, PLAYLIST_INDEX_ERROR)
+
+# ARGV: index, entry. The index may also be the length of the playlist to append
+INSERT_AT = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local entries = load(KEYS[1])
+local index = tonumber(ARGV[1])
+if index == nil or index < -#entries or index > #entries then
+    return index_error()
+end
+if index < 0 then
+    index = index + #entries
+end
+table.insert(entries, index + 1, ARGV[2])
+store(KEYS[1], entries)
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, true)
+"""
+
+# ARGV: from index, to index. The moved entry ends up at to index
+MOVE = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local entries = load(KEYS[1])
+local from_position = position(ARGV[1], #entries)
+local to_position = position(ARGV[2], #entries)
+if from_position == nil or to_position == nil then
+    return index_error()
+end
+table.insert(entries, to_position, table.remove(entries, from_position))
+store(KEYS[1], entries)
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, true)
+"""
+
+# ARGV: index
+REMOVE_AT = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local entries = load(KEYS[1])
+local remove_position = position(ARGV[1], #entries)
+if remove_position == nil then
+    return index_error()
+end
+table.remove(entries, remove_position)
+store(KEYS[1], entries)
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, true)
+"""
+
+# ARGV: entries. Entries whose id is already queued are skipped
+APPEND_UNIQUE = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local queued = {}
+for _, entry in ipairs(load(KEYS[1])) do
+    queued[entry_id(entry)] = true
+end
+local changed = false
+for _, entry in ipairs(ARGV) do
+    local id = entry_id(entry)
+    if not queued[id] then
+        redis.call('RPUSH', KEYS[1], entry)
+        queued[id] = true
+        changed = true
+    end
+end
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, changed)
+"""
+
+# ARGV: entries
+REPLACE_ALL = _HEADER + """
+local channel = table.remove(ARGV, 1)
+store(KEYS[1], ARGV)
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, true)
+"""
+
+# ARGV: track id
+REMOVE_TRACK = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local kept = {}
+local changed = false
+for _, entry in ipairs(load(KEYS[1])) do
+    if entry_id(entry) == ARGV[1] then
+        changed = true
+    else
+        table.insert(kept, entry)
+    end
+end
+if changed then
+    store(KEYS[1], kept)
+end
+return reply(KEYS[1], KEYS[2], KEYS[3], channel, changed)
+"""
+
+# KEYS: playlist, playlist version and channel version key of every channel.
+# ARGV: number of channels, the channel names in the same order, then track ids.
+# Strips the tracks from every playlist in one pass and replies the names of the changed channels
+STRIP_TRACKS = _HEADER + """
+local count = tonumber(ARGV[1])
+local stripped = {}
+for index = count + 2, #ARGV do
+    stripped[ARGV[index]] = true
+end
+local changed_channels = {}
+for channel_index = 1, count do
+    local key_index = channel_index * 3 - 2
+    local channel = ARGV[channel_index + 1]
+    local kept = {}
+    local changed = false
+    for _, entry in ipairs(load(KEYS[key_index])) do
+        if stripped[entry_id(entry)] then
+            changed = true
+        else
+            table.insert(kept, entry)
+        end
+    end
+    if changed then
+        store(KEYS[key_index], kept)
+        bump(KEYS[key_index + 1], KEYS[key_index + 2], channel)
+        table.insert(changed_channels, channel)
+    end
+end
+return changed_channels
+"""
+
+# KEYS: playlist, playlist version, channel version and now playing key.
+# ARGV: track id of the played track, then the now playing hash as field, value pairs.
+# The daemon plays from the head, so the played entry and any skipped before it leave the playlist.
+# Replies the playlist version and the number of entries taken off the head, 0 if the track was not queued
+PLAY_HEAD = _HEADER + """
+local channel = table.remove(ARGV, 1)
+local track_id = table.remove(ARGV, 1)
+local played = 0
+for index, entry in ipairs(load(KEYS[1])) do
+    if entry_id(entry) == track_id then
+        played = index
+        break
+    end
+end
+if played > 0 then
+    redis.call('LTRIM', KEYS[1], played, -1)
+end
+redis.call('DEL', KEYS[4])
+for index = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[4], ARGV[index], ARGV[index + 1])
+end
+local version
+if played > 0 then
+    version = bump(KEYS[2], KEYS[3], channel)
+else
+    version = tonumber(redis.call('GET', KEYS[2]) or 0)
+    publish(channel, redis.call('INCR', KEYS[3]))
+end
+return {version, played}
+"""
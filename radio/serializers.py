@@ -1,5 +1,6 @@
 from datetime import datetime
 from dateutil.tz import tzlocal
+from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from accounts.serializers import UserSerializer
 from .models import (
@@ -55,6 +56,46 @@ class TrackSerializer(serializers.ModelSerializer):
         )
 
 
+class TrackValuesSerializer(object):
+    """
+    Read-only TrackSerializer output built straight from .values() rows.
+
+    TrackSerializer's fields are resolved once here. Per row only the time fields go through their
+    to_representation, the other values are output as the database returned them, and every uploader
+    is serialized once in a single query however many of the tracks are theirs
+    """
+    def __init__(self):
+        fields = TrackSerializer().fields
+        self.names = [name for name, field in fields.items() if not field.write_only]
+        self.columns = [name for name in self.names if name != 'user'] + ['user_id']
+        self.converters = [
+            (name, fields[name].to_representation) for name in self.names
+            if isinstance(fields[name], (serializers.TimeField, serializers.DateTimeField))
+        ]
+
+    def values(self, queryset):
+        return queryset.values(*self.columns)
+
+    def get_users(self, user_ids):
+        # The user is in an external database, it cannot be joined into the track rows
+        users = get_user_model().objects.filter(id__in=user_ids).select_related('profile')
+        return {user.id: UserSerializer(user).data for user in users}
+
+    def to_representation(self, rows):
+        users = self.get_users({row["user_id"] for row in rows})
+        data = []
+        for row in rows:
+            track = {name: row.get(name) for name in self.names}
+            track["user"] = users.get(row["user_id"])
+            for name, to_representation in self.converters:
+                track[name] = to_representation(track[name])
+            data.append(track)
+        return data
+
+
+track_values_serializer = TrackValuesSerializer()
+
+
 class TrackAPISerializer(serializers.Serializer):
     is_service = serializers.BooleanField(default=True, allow_null=False)
 
@@ -158,7 +199,8 @@ class PlayHistorySerializer(serializers.ModelSerializer):
 class PlayQueueSerializer(serializers.Serializer):
     id = serializers.IntegerField()
 
-    location = serializers.CharField(allow_null=True, allow_blank=True, max_length=255)
+    # Optional, daemon builds which leave it out of the on_play callback still update now playing
+    location = serializers.CharField(required=False, default=None, allow_null=True, allow_blank=True, max_length=255)
     title = serializers.CharField(allow_null=True, allow_blank=True, max_length=200)
     artist = serializers.CharField(allow_null=True, allow_blank=True, max_length=70)
 
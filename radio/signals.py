@@ -0,0 +1,35 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+from .models import Track
+from .index import index_track, unindex_track
+from .util import bump_catalogue_generation
+
+
+@receiver(post_save, sender=Track)
+def update_track_index(sender, instance, *args, **kwargs):
+    # Upload, channel edits and on_play all save the track.
+    # Wait for commit so a rolled back request never reaches the index
+    transaction.on_commit(lambda: index_track(instance))
+
+
+@receiver(post_delete, sender=Track)
+def remove_track_index(sender, instance, *args, **kwargs):
+    track_id = instance.id
+    transaction.on_commit(lambda: unindex_track(track_id))
+
+
+def bump_catalogue_generation_on_commit():
+    try:
+        bump_catalogue_generation()
+    except RedisError as e:
+        # Cached track list pages fall back to expiring
+        print('redis error: {}'.format(e))
+
+
+@receiver(post_save, sender=Track)
+@receiver(post_delete, sender=Track)
+def invalidate_track_list_cache(sender, *args, **kwargs):
+    # Bumped before the commit, a page still built from the old rows could be stored under the new generation
+    transaction.on_commit(bump_catalogue_generation_on_commit)
@@ -0,0 +1,87 @@
+import time
+import threading
+from redis import StrictRedis
+from redis.client import Pipeline
+from . import metrics
+
+
+_local = threading.local()
+
+
+class RequestState(object):
+    """
+    Redis state read by a single request.
+    Channel data and the pending remove set are fetched at most once and dropped on write
+    """
+    def __init__(self):
+        self.redis_calls = 0
+        self.channels = {}
+        self.pending_remove = None
+        self.loaded = False
+
+    def invalidate(self, channel=None, pending_remove=False):
+        if channel is not None:
+            self.channels.pop(channel, None)
+        if pending_remove:
+            self.pending_remove = None
+
+
+def begin_request_state():
+    _local.state = RequestState()
+    return _local.state
+
+
+def end_request_state():
+    _local.state = None
+
+
+def get_request_state():
+    return getattr(_local, 'state', None)
+
+
+def invalidate_request_state(channel=None, pending_remove=False):
+    state = get_request_state()
+    if state is not None:
+        state.invalidate(channel=channel, pending_remove=pending_remove)
+
+
+def count_redis_call():
+    state = get_request_state()
+    if state is not None:
+        state.redis_calls += 1
+
+
+class CountingPipeline(Pipeline):
+    """
+    Count a pipeline as one call per round-trip
+    """
+    def immediate_execute_command(self, *args, **options):
+        count_redis_call()
+        return super().immediate_execute_command(*args, **options)
+
+    def execute(self, *args, **kwargs):
+        if not self.command_stack:
+            return super().execute(*args, **kwargs)
+
+        count_redis_call()
+        started = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            metrics.observe("redis.command", time.perf_counter() - started)
+
+
+class CountingRedis(StrictRedis):
+    """
+    Redis client which counts round-trips made by the current request and their latency
+    """
+    def execute_command(self, *args, **options):
+        count_redis_call()
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.observe("redis.command", time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
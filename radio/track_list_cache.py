@@ -0,0 +1,70 @@
+"""
+Redis cache of the public track list pages served to anonymous listeners.
+
+A page is stored under its normalized query parameters and the catalogue generation. Every change
+of the listed tracks bumps the generation: post_save and post_delete of a Track, a soft delete and
+every pending remove change, so a page never shows a track reserved pending remove after the
+reservation. Pages of an older generation are never read again and expire after TRACK_LIST_CACHE_TTL
+seconds, which also bounds how long play_count and last_played_at, updated by on_play without a
+signal, can lag.
+"""
+import json
+import time
+import hashlib
+from redis.exceptions import RedisError
+from . import metrics
+from .util import redis_server, get_catalogue_generation
+
+
+TRACK_LIST_CACHE_KEY = "track_list:{}:{}"
+TRACK_LIST_CACHE_TTL = 60
+
+
+def get_track_list_cache_key(generation, params):
+    normalized = json.dumps(sorted(params.items()), separators=(',', ':'))
+    return TRACK_LIST_CACHE_KEY.format(generation, hashlib.sha1(normalized.encode('utf-8')).hexdigest())
+
+
+def get_cached_track_list(params, build):
+    """
+    :param params: dict of the query parameters which make the page, normalized by the caller
+    :param build: function returning the payload of the page, called on a miss
+    :return: payload of the page
+    """
+    try:
+        # Read before building, a change meanwhile stores the page under the outdated generation
+        key = get_track_list_cache_key(get_catalogue_generation(), params)
+        cached = redis_server.get(key)
+    except RedisError as e:
+        print('track list cache error: {}'.format(e))
+        metrics.incr("track_list_cache.bypass")
+        return build()
+
+    if cached is not None:
+        metrics.incr("track_list_cache.hit")
+        return json.loads(cached)
+
+    metrics.incr("track_list_cache.miss")
+    started = time.perf_counter()
+    payload = build()
+    metrics.observe("track_list_cache.rebuild", time.perf_counter() - started)
+    try:
+        redis_server.set(key, json.dumps(payload), ex=TRACK_LIST_CACHE_TTL)
+    except RedisError as e:
+        print('track list cache error: {}'.format(e))
+    return payload
+
+
+def get_track_list_cache_stats(counters):
+    """
+    :param counters: dict returned by metrics.get_metrics
+    :return: dict of hit, miss, bypass and hit_ratio of the worker
+    """
+    hit = counters.get("track_list_cache.hit", 0)
+    miss = counters.get("track_list_cache.miss", 0)
+    return {
+        "hit": hit,
+        "miss": miss,
+        "bypass": counters.get("track_list_cache.bypass", 0),
+        "hit_ratio": round(hit / (hit + miss), 4) if hit + miss else 0.0,
+    }
@@ -7,6 +7,8 @@ app_name = 'radio'
 urlpatterns = [
     path('list', views.TrackListAPI.as_view()),
     path('mytrack', views.MyTrackAPI.as_view()),
+    path('export/tracks', views.TrackExportAPI.as_view()),
+    path('export/playhistory', views.PlayHistoryExportAPI.as_view()),
     path('track/<int:track_id>', views.TrackAPI.as_view()),
     path('like/<int:track_id>', views.LikeAPI.as_view()),
     path('channelname/<str:channel>', views.ChannelNameAPI.as_view()),
@@ -19,4 +21,5 @@ urlpatterns = [
     path('callback/on_startup/<str:channel>', views.CallbackOnStartupAPI.as_view()),
     path('callback/on_play/<str:channel>', views.CallbackOnPlayAPI.as_view()),
     path('callback/on_stop/<str:channel>', views.CallbackOnStopAPI.as_view()),
+    path('metrics', views.MetricsAPI.as_view()),
 ]
@@ -1,210 +1,888 @@
-import os
+import copy
+import time
 import random
 import json
 import redis
 from datetime import datetime, timedelta
 from dateutil.tz import tzlocal
-from django.db.models import Q
-from django_utils import storage
+from django.conf import settings
+from django.db import connection, transaction
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Q, Min, Max
+from django.db.models.functions import Greatest
+from django.db.models.expressions import RawSQL
 from django.utils.translation import ugettext_lazy as _
-from google.api_core.exceptions import NotFound
 from rest_framework.exceptions import ValidationError
+from .connection import shared_connection_pool
+from .state import CountingRedis, get_request_state, invalidate_request_state
+from . import scripts
+from .scripts import PLAYLIST_INDEX_ERROR, CHANNEL_EVENTS
+from .channel_cache import invalidate_channel_cache
 
 
-redis_host = os.environ.get('REDIS_URL')
-redis_port = os.environ.get('REDIS_PORT')
-redis_db = os.environ.get('REDIS_DB')
-redis_server = redis.StrictRedis(host=redis_host, port=redis_port, db=redis_db)
+redis_server = CountingRedis(connection_pool=shared_connection_pool)
+
+# Sent with EVALSHA, loaded into Redis by the first call which gets NOSCRIPT
+insert_at_script = redis_server.register_script(scripts.INSERT_AT)
+move_script = redis_server.register_script(scripts.MOVE)
+remove_at_script = redis_server.register_script(scripts.REMOVE_AT)
+append_unique_script = redis_server.register_script(scripts.APPEND_UNIQUE)
+replace_all_script = redis_server.register_script(scripts.REPLACE_ALL)
+remove_track_script = redis_server.register_script(scripts.REMOVE_TRACK)
+strip_tracks_script = redis_server.register_script(scripts.STRIP_TRACKS)
+play_head_script = redis_server.register_script(scripts.PLAY_HEAD)
 
 
 NUM_SAMPLES = 21
 
+# Channel state. The playlist is a list of compact JSON entries and now playing a hash
+PLAYLIST_KEY = "channel:{}:playlist"
+NOW_PLAYING_KEY = "channel:{}:now_playing"
+# Bumped by every change of the playlist or now playing
+CHANNEL_VERSION_KEY = "channel:{}:version"
+# Bumped by one per playlist mutation. Sequence number of the deltas sent to the music daemon
+PLAYLIST_VERSION_KEY = "channel:{}:playlist_version"
+
+# Track ids reserved to be removed once they stop playing
+PENDING_REMOVE_KEY = "pending_remove:ids"
+LEGACY_PENDING_REMOVE_KEY = "pending_remove"
+# Bumped by every change of the tracks the public track list shows. Part of its cache keys
+CATALOGUE_GENERATION_KEY = "catalogue:generation"
+_smismember_supported = True
+
+SELECTION_MODE_RANDOM = "random"
+SELECTION_MODE_HARMONIC = "harmonic"
+
+# According to International Radio Law, Once played track cannot restream in 3 hours
+LOCKOUT_PLAYED = timedelta(hours=3)
+# Newly uploaded track waits before first stream
+LOCKOUT_UPLOADED = timedelta(minutes=10)
+
+# Extra candidates fetched with the next track so on_stop usually needs no query
+NUM_SPARES = 4
+SPARE_KEY = "spare:{}"
+SPARE_TTL = 600
+
+# Columns required to build a playlist entry. Sampling never loads the full row.
+PLAYLIST_FIELDS = ('id', 'location', 'artist', 'title')
+
+SAMPLE_STRATEGY_ID_RANGE = "id_range"
+SAMPLE_STRATEGY_TABLESAMPLE = "tablesample"
+SAMPLE_STRATEGY_ORDER_RANDOM = "order_random"
+SAMPLE_STRATEGY = [
+    SAMPLE_STRATEGY_ID_RANGE,
+    SAMPLE_STRATEGY_TABLESAMPLE,
+]
+
+# How many candidates to draw per wanted track, doubled on every retry
+SAMPLE_OVERSAMPLE = 4
+SAMPLE_MAX_ATTEMPTS = 3
+
+# Below this many rows ORDER BY random() is cheaper than any sampling strategy
+SAMPLE_MIN_ROWS = 5000
+
+# Id range sampling reuses the table's id bounds this long. A track uploaded since
+# is locked out for LOCKOUT_UPLOADED anyway, so bounds this old miss nothing playable
+SAMPLE_ID_BOUNDS_TTL = LOCKOUT_UPLOADED.total_seconds()
+_sample_id_bounds = None
+
+# Columns of the keyword search, each with a pg_trgm GIN index
+SEARCH_FIELDS = ('title', 'artist', 'description')
+# A keyword found in the long description is a weaker match than in the title or artist
+SEARCH_DESCRIPTION_WEIGHT = 0.5
+
 
 def now():
     return str(datetime.now(tz=tzlocal()).isoformat())
 
 
-def get_redis_data(channel):
-    raw_json = redis_server.get(channel)
-    if raw_json is None:
-        default_data = {
-            "now_playing": None,
-            "playlist": None
-        }
-        redis_server.set(channel, json.dumps(default_data, ensure_ascii=False).encode('utf-8'))
+def get_selection_mode(channel):
+    return getattr(settings, 'RADIO_SELECTION_MODE', {}).get(channel, SELECTION_MODE_RANDOM)
+
+
+def get_playlist_key(channel):
+    return PLAYLIST_KEY.format(channel)
+
+
+def get_now_playing_key(channel):
+    return NOW_PLAYING_KEY.format(channel)
+
+
+def get_channel_version_key(channel):
+    return CHANNEL_VERSION_KEY.format(channel)
+
+
+def get_playlist_version_key(channel):
+    return PLAYLIST_VERSION_KEY.format(channel)
+
+
+def encode_entry(entry):
+    return json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def decode_playlist(raw_entries):
+    return [json.loads(raw_entry) for raw_entry in raw_entries]
+
+
+def decode_now_playing(raw_hash):
+    if not raw_hash:
+        return None
+    now_playing = {}
+    for field, value in raw_hash.items():
+        now_playing[field.decode('utf-8')] = value.decode('utf-8')
     try:
-        data_json = json.loads(raw_json)
-    except Exception as e:
-        print('redis error: {}'.format(e))
+        now_playing["id"] = int(now_playing["id"])
+    except (KeyError, ValueError):
+        pass
+    return now_playing
+
+
+def publish_channel_event(channel, version):
+    redis_server.publish(CHANNEL_EVENTS, json.dumps({"channel": channel, "version": version}))
+
+
+def invalidate_channel_state(channel):
+    """
+    Drop channel from the request snapshot and the process cache after a write
+    """
+    invalidate_request_state(channel)
+    invalidate_channel_cache(channel)
+
+
+def migrate_redis_data(channel):
+    """
+    Convert the legacy single JSON document of a channel to the native playlist list and now playing hash.
+    A playlist already stored natively wins over the legacy one, only now playing is taken from the document
+
+    :return: True if a legacy document was migrated
+    """
+    from .models import CHANNEL
+
+    # The channel may come from a URL. Any other string key is left alone, never deleted
+    if channel not in dict(CHANNEL):
+        return False
+
+    playlist_key = get_playlist_key(channel)
+    now_playing_key = get_now_playing_key(channel)
+
+    with redis_server.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(channel, playlist_key)
+                if pipe.type(channel) != b'string':
+                    pipe.unwatch()
+                    return False
+                raw_json = pipe.get(channel)
+                has_playlist = pipe.exists(playlist_key) > 0
+
+                try:
+                    legacy_data = dict(json.loads(raw_json))
+                except Exception as e:
+                    print('redis error: {}'.format(e))
+                    legacy_data = {}
+                now_playing = legacy_data.get("now_playing")
+                playlist = legacy_data.get("playlist")
+
+                pipe.multi()
+                if not has_playlist and playlist:
+                    pipe.rpush(playlist_key, *[encode_entry(entry) for entry in playlist])
+                    pipe.incr(get_playlist_version_key(channel))
+                if now_playing:
+                    pipe.delete(now_playing_key)
+                    pipe.hset(now_playing_key, mapping={
+                        field: str(value) for field, value in now_playing.items() if value is not None
+                    })
+                pipe.delete(channel)
+                pipe.incr(get_channel_version_key(channel))
+                version = pipe.execute()[-1]
+                publish_channel_event(channel, version)
+                invalidate_channel_state(channel)
+                return True
+            except redis.WatchError:
+                continue
+
+
+def fetch_redis_data(channels, pending_remove=False):
+    """
+    Fetch channel data of many channels, and the pending remove set if asked, in one pipeline
+
+    :return: (dict of channel and its data, set of pending remove track id or None)
+    """
+    channels = list(channels)
+    # MULTI so the version always matches the data it is returned with
+    pipe = redis_server.pipeline(transaction=True)
+    for channel in channels:
+        pipe.lrange(get_playlist_key(channel), 0, -1)
+        pipe.hgetall(get_now_playing_key(channel))
+        pipe.exists(channel)
+        pipe.get(get_channel_version_key(channel))
+    if pending_remove:
+        pipe.smembers(PENDING_REMOVE_KEY)
+    result = pipe.execute()
+
+    redis_data = {}
+    for index, channel in enumerate(channels):
+        raw_playlist, raw_now_playing, has_legacy_data, raw_version = result[index * 4:index * 4 + 4]
+        if has_legacy_data and migrate_redis_data(channel):
+            redis_data[channel] = fetch_redis_data([channel])[0][channel]
+        else:
+            redis_data[channel] = {
+                "now_playing": decode_now_playing(raw_now_playing),
+                "playlist": decode_playlist(raw_playlist),
+                "version": int(raw_version or 0)
+            }
+
+    pending_remove_ids = None
+    if pending_remove:
+        pending_remove_ids = set(int(member) for member in result[-1])
+    return redis_data, pending_remove_ids
+
+
+def load_request_state(state, channel=None):
+    """
+    Fill the request snapshot. The first load takes every service channel and the pending set together
+    """
+    from .models import SERVICE_CHANNEL
+
+    channels = set()
+    if not state.loaded:
+        channels.update(SERVICE_CHANNEL)
+    if channel is not None:
+        channels.add(channel)
+    channels.difference_update(state.channels.keys())
+
+    redis_data, pending_remove_ids = fetch_redis_data(channels, pending_remove=state.pending_remove is None)
+    state.channels.update(redis_data)
+    if pending_remove_ids is not None:
+        state.pending_remove = pending_remove_ids
+    state.loaded = True
+
+
+def get_redis_data(channel):
+    """
+    :return: dict of "now_playing" (dict or None), "playlist" (list, empty if nothing is queued)
+             and "version" (int, bumped by every change)
+    """
+    state = get_request_state()
+    if state is None:
+        return fetch_redis_data([channel])[0][channel]
+
+    if channel not in state.channels:
+        load_request_state(state, channel)
+    return copy.deepcopy(state.channels[channel])
+
+
+def get_pending_remove_snapshot():
+    """
+    :return: set of pending remove track id of the request snapshot. None outside of a request
+    """
+    state = get_request_state()
+    if state is None:
         return None
-    return dict(data_json)
+
+    if state.pending_remove is None:
+        load_request_state(state)
+    return state.pending_remove
 
 
 def set_redis_data(channel, key, value):
-    redis_data = get_redis_data(channel)
-    redis_data[key] = value
-    redis_server.set(channel, json.dumps(redis_data, ensure_ascii=False).encode('utf-8'))
+    if key == "playlist":
+        return replace_playlist(channel, value)
+    elif key == "now_playing":
+        set_now_playing(channel, value)
+    else:
+        raise KeyError(key)
+
+
+def set_now_playing(channel, now_playing):
+    now_playing_key = get_now_playing_key(channel)
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.delete(now_playing_key)
+    if now_playing:
+        pipe.hset(now_playing_key, mapping={
+            field: str(value) for field, value in now_playing.items() if value is not None
+        })
+    pipe.incr(get_channel_version_key(channel))
+    version = pipe.execute()[-1]
+    publish_channel_event(channel, version)
+    invalidate_channel_state(channel)
+
+
+def play_playlist_head(channel, now_playing):
+    """
+    Set now playing and take the played track, with the entries skipped before it, off the head
+    of the playlist in one script, so the playlist never keeps what already played
+
+    :return: (playlist version, number of entries taken off the head, 0 if the track was not queued)
+    """
+    args = [channel, int(now_playing["id"])]
+    for field, value in now_playing.items():
+        if value is not None:
+            args += [field, str(value)]
+    keys = [
+        get_playlist_key(channel), get_playlist_version_key(channel), get_channel_version_key(channel),
+        get_now_playing_key(channel)
+    ]
+    try:
+        version, played = play_head_script(keys=keys, args=args)
+    finally:
+        invalidate_channel_state(channel)
+    return int(version), int(played)
+
 
+def run_playlist_script(script, channel, *args):
+    """
+    Run a playlist script of radio.scripts in one round-trip
 
-def get_pending_remove():
-    pending_remove = redis_server.get('pending_remove')
-    if pending_remove is None:
-        default_data = {
-            "list": None
-        }
-        redis_server.set('pending_remove', json.dumps(default_data, ensure_ascii=False).encode('utf-8'))
+    :return: (playlist version, playlist) after the mutation
+    :raise IndexError: index is out of range
+    """
+    keys = [get_playlist_key(channel), get_playlist_version_key(channel), get_channel_version_key(channel)]
     try:
-        data_json = json.loads(pending_remove)
+        result = script(keys=keys, args=(channel,) + args)
+    except redis.ResponseError as e:
+        if PLAYLIST_INDEX_ERROR in str(e):
+            raise IndexError(args[0])
+        raise
+    finally:
+        invalidate_channel_state(channel)
+    return int(result[0]), decode_playlist(result[1:])
+
+
+def get_channel_version(channel):
+    """
+    A legacy document left by the music daemon is migrated first, which bumps the version
+    """
+    version_key = get_channel_version_key(channel)
+    pipe = redis_server.pipeline(transaction=False)
+    pipe.get(version_key)
+    pipe.exists(channel)
+    raw_version, has_legacy_data = pipe.execute()
+    if has_legacy_data and migrate_redis_data(channel):
+        raw_version = redis_server.get(version_key)
+    return int(raw_version or 0)
+
+
+def get_playlist_snapshot(channel):
+    """
+    :return: (playlist version, playlist) read together
+    """
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.get(get_playlist_version_key(channel))
+    pipe.lrange(get_playlist_key(channel), 0, -1)
+    raw_version, raw_playlist = pipe.execute()
+    return int(raw_version or 0), decode_playlist(raw_playlist)
+
+
+def replace_playlist(channel, playlist):
+    """
+    :return: (playlist version, playlist)
+    """
+    return run_playlist_script(replace_all_script, channel, *[encode_entry(entry) for entry in playlist or []])
+
+
+def append_playlist(channel, *entries):
+    """
+    Append entries at the end of the playlist. Entries of already queued tracks are skipped
+
+    :return: (playlist version, playlist)
+    """
+    return run_playlist_script(append_unique_script, channel, *[encode_entry(entry) for entry in entries])
+
+
+def insert_playlist(channel, index, entry):
+    """
+    Insert entry at index. index may be the length of the playlist to append
+
+    :return: (playlist version, playlist)
+    :raise IndexError: index is out of range
+    """
+    return run_playlist_script(insert_at_script, channel, index, encode_entry(entry))
+
+
+def move_playlist(channel, from_index, to_index):
+    """
+    :return: (playlist version, playlist)
+    :raise IndexError: from_index or to_index is out of range
+    """
+    return run_playlist_script(move_script, channel, from_index, to_index)
+
+
+def remove_playlist(channel, index):
+    """
+    :return: (playlist version, playlist)
+    :raise IndexError: index is out of range
+    """
+    return run_playlist_script(remove_at_script, channel, index)
+
+
+def remove_track_from_playlist(channel, track_id):
+    """
+    Remove every entry of track_id from the playlist
+
+    :return: (playlist version, playlist)
+    """
+    return run_playlist_script(remove_track_script, channel, int(track_id))
+
+
+def migrate_pending_remove():
+    """
+    Move ids of the legacy JSON pending_remove document into the pending remove set
+
+    :return: number of migrated ids
+    """
+    raw_json = redis_server.get(LEGACY_PENDING_REMOVE_KEY)
+    if raw_json is None:
+        return 0
+    try:
+        pending_remove_list = json.loads(raw_json)["list"] or []
     except Exception as e:
         print('redis error: {}'.format(e))
-        return None
-    return dict(data_json)
+        pending_remove_list = []
+
+    pipe = redis_server.pipeline(transaction=True)
+    if pending_remove_list:
+        pipe.sadd(PENDING_REMOVE_KEY, *pending_remove_list)
+        bump_catalogue_generation(pipe)
+    pipe.delete(LEGACY_PENDING_REMOVE_KEY)
+    pipe.execute()
+    invalidate_request_state(pending_remove=True)
+    return len(pending_remove_list)
 
 
-def set_pending_remove(remove_list):
-    pending_remove = get_pending_remove()
-    pending_remove["list"] = remove_list
-    redis_server.set('pending_remove', json.dumps(pending_remove, ensure_ascii=False).encode('utf-8'))
+def get_catalogue_generation():
+    return int(redis_server.get(CATALOGUE_GENERATION_KEY) or 0)
+
+
+def bump_catalogue_generation(pipeline=None):
+    (pipeline or redis_server).incr(CATALOGUE_GENERATION_KEY)
 
 
 def get_is_pending_remove(track_id):
-    pending_remove = get_pending_remove()
-    if pending_remove is None:
-        return False
-    else:
-        pending_remove_list = pending_remove["list"]
-        if pending_remove_list is not None:
-            try:
-                index = pending_remove_list.index(track_id)
-            except ValueError:
-                return False
-            else:
-                return True
-        else:
-            return False
+    pending_remove_ids = get_pending_remove_snapshot()
+    if pending_remove_ids is not None:
+        return int(track_id) in pending_remove_ids
+    return bool(redis_server.sismember(PENDING_REMOVE_KEY, int(track_id)))
+
+
+def are_pending_remove(track_ids):
+    """
+    Answer pending remove membership of many tracks in one round-trip
+
+    :return: set of track id reserved pending remove
+    """
+    global _smismember_supported
+
+    track_ids = [int(track_id) for track_id in track_ids]
+    if not track_ids:
+        return set()
 
+    pending_remove_ids = get_pending_remove_snapshot()
+    if pending_remove_ids is not None:
+        return pending_remove_ids.intersection(track_ids)
 
-def remove_pending_track():
+    if _smismember_supported:
+        try:
+            result = redis_server.smismember(PENDING_REMOVE_KEY, track_ids)
+        except redis.ResponseError:
+            # SMISMEMBER needs Redis 6.2
+            _smismember_supported = False
+    if not _smismember_supported:
+        pipe = redis_server.pipeline(transaction=False)
+        for track_id in track_ids:
+            pipe.sismember(PENDING_REMOVE_KEY, track_id)
+        result = pipe.execute()
+
+    return set(track_id for track_id, is_member in zip(track_ids, result) if is_member)
+
+
+def add_pending_remove(track_id):
+    """
+    :return: True if newly reserved, False if it was already reserved
+    """
+    invalidate_request_state(pending_remove=True)
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.sadd(PENDING_REMOVE_KEY, int(track_id))
+    bump_catalogue_generation(pipe)
+    return pipe.execute()[0] == 1
+
+
+def cancel_pending_remove(track_id):
+    """
+    :return: True if the reservation was cancelled, False if the track was not reserved
+    """
+    invalidate_request_state(pending_remove=True)
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.srem(PENDING_REMOVE_KEY, int(track_id))
+    bump_catalogue_generation(pipe)
+    return pipe.execute()[0] == 1
+
+
+def get_releasable_pending_remove():
+    """
+    :return: list of track id reserved pending remove which are not playing on any service channel anymore
+    """
+    from .models import SERVICE_CHANNEL
+
+    pending_ids = [int(member) for member in redis_server.smembers(PENDING_REMOVE_KEY)]
+    if not pending_ids:
+        return []
+
+    playing_ids = get_now_playing_ids(SERVICE_CHANNEL)
+    return [track_id for track_id in pending_ids if track_id not in playing_ids]
+
+
+def release_pending_remove(track_ids):
+    """
+    Take tracks out of the pending remove set. Call once their soft delete committed,
+    a track released before would show again should the delete roll back
+    """
+    if not track_ids:
+        return
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.srem(PENDING_REMOVE_KEY, *[int(track_id) for track_id in track_ids])
+    bump_catalogue_generation(pipe)
+    pipe.execute()
+    invalidate_request_state(pending_remove=True)
+
+
+def strip_tracks_from_playlists(track_ids):
+    """
+    Remove tracks from the playlist of every service channel in one round-trip
+
+    :return: list of channel whose playlist changed
+    """
+    from .models import SERVICE_CHANNEL
+
+    if not track_ids:
+        return []
+    keys = []
+    for channel in SERVICE_CHANNEL:
+        keys += [get_playlist_key(channel), get_playlist_version_key(channel), get_channel_version_key(channel)]
+    changed = strip_tracks_script(
+        keys=keys, args=[len(SERVICE_CHANNEL)] + list(SERVICE_CHANNEL) + [int(track_id) for track_id in track_ids]
+    )
+    for channel in SERVICE_CHANNEL:
+        invalidate_channel_state(channel)
+    return [channel.decode('utf-8') if isinstance(channel, bytes) else channel for channel in changed]
+
+
+def get_pending_remove_ids():
+    pending_remove_ids = get_pending_remove_snapshot()
+    if pending_remove_ids is not None:
+        return list(pending_remove_ids)
+    return [int(member) for member in redis_server.smembers(PENDING_REMOVE_KEY)]
+
+
+def estimate_track_rows():
     from .models import (
         Track
     )
 
-    pending_remove = get_pending_remove()
-    if pending_remove is None:
-        pass
-    else:
-        pending_remove_list = pending_remove["list"]
-        if pending_remove_list is not None:
-            while pending_remove_list:
-                track_id = pending_remove_list.pop()
-                try:
-                    track = Track.objects.get(id=track_id)
-                except Track.DoesNotExist:
-                    pass
-                else:
-                    if track:
-                        delete_track(track, force=True)
-        set_pending_remove(pending_remove_list)
+    # Planner statistics are good enough to size a sample and avoid a COUNT(*)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [Track._meta.db_table]
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return 0
+    return max(int(row[0]), 0)
 
 
-def get_random_track(channel, samples):
+def get_track_id_bounds():
+    """
+    Lowest and highest track id, kept for SAMPLE_ID_BOUNDS_TTL seconds.
+    Taken from the whole table, Min and Max of the primary key are two index lookups
+
+    :return: (low, high), both None for an empty table
+    """
     from .models import (
         Track
     )
+    global _sample_id_bounds
+
+    if _sample_id_bounds is None or _sample_id_bounds[0] < time.monotonic():
+        bounds = Track.all_objects.aggregate(low=Min('id'), high=Max('id'))
+        _sample_id_bounds = (time.monotonic() + SAMPLE_ID_BOUNDS_TTL, bounds["low"], bounds["high"])
+    return _sample_id_bounds[1], _sample_id_bounds[2]
+
+
+def reset_track_id_bounds():
+    global _sample_id_bounds
+    _sample_id_bounds = None
+
+
+def _sample_id_range(queryset, samples, exclude_ids, attempt):
+    low, high = get_track_id_bounds()
+    if low is None or high is None:
+        return []
+
+    span = high - low + 1
+    num_candidates = min(span, samples * SAMPLE_OVERSAMPLE * (2 ** attempt))
+    candidates = random.sample(range(low, high + 1), num_candidates)
+
+    # Shuffled, the first rows of an unordered scan would favour the low heap pages
+    return list(
+        queryset.filter(id__in=candidates).exclude(id__in=exclude_ids).order_by('?').only(*PLAYLIST_FIELDS)[:samples]
+    )
+
+
+def _sample_tablesample(queryset, samples, exclude_ids, attempt):
+    total_rows = estimate_track_rows()
+    if total_rows < 1:
+        return []
+
+    percent = min(100.0, 100.0 * samples * SAMPLE_OVERSAMPLE * (2 ** attempt) / total_rows)
+    # SYSTEM reads only the sampled pages, BERNOULLI would read every page of the table
+    sampled_ids = RawSQL(
+        "SELECT id FROM {} TABLESAMPLE SYSTEM (%s)".format(queryset.model._meta.db_table), (percent,)
+    )
+
+    return list(
+        queryset.filter(id__in=sampled_ids).exclude(id__in=exclude_ids).order_by('?').only(*PLAYLIST_FIELDS)[:samples]
+    )
+
+
+def _sample_order_random(queryset, samples, exclude_ids):
+    return list(queryset.exclude(id__in=exclude_ids).order_by('?').only(*PLAYLIST_FIELDS)[:samples])
+
+
+SAMPLE_STRATEGY_FUNCTION = {
+    SAMPLE_STRATEGY_ID_RANGE: _sample_id_range,
+    SAMPLE_STRATEGY_TABLESAMPLE: _sample_tablesample,
+}
+
+
+def sample_tracks(queryset, samples, strategies=None, exclude_ids=None):
+    """
+    Pick up to `samples` random tracks from queryset inside the database
+
+    :param queryset: eligible Track queryset
+    :param samples: number of tracks wanted
+    :param strategies: sampling strategies tried in order. default=SAMPLE_STRATEGY
+    :param exclude_ids: track ids never picked. Merged with already picked ids into one NOT IN predicate
+    :return: list of Track instances loaded with PLAYLIST_FIELDS only, in random order
+    """
+    if samples < 1:
+        return []
+    exclude_ids = list(exclude_ids or [])
+
+    if strategies is None:
+        strategies = SAMPLE_STRATEGY
+        if estimate_track_rows() < SAMPLE_MIN_ROWS:
+            strategies = []
+
+    picked = {}
+    for strategy in strategies:
+        sample_function = SAMPLE_STRATEGY_FUNCTION[strategy]
+        for attempt in range(SAMPLE_MAX_ATTEMPTS):
+            for track in sample_function(queryset, samples - len(picked), exclude_ids + list(picked.keys()), attempt):
+                picked[track.id] = track
+            if len(picked) >= samples:
+                break
+        if len(picked) >= samples:
+            break
+
+    if len(picked) < samples:
+        # Eligible tracks are too sparse to hit by sampling, let the database shuffle the rest
+        for track in _sample_order_random(queryset, samples - len(picked), exclude_ids + list(picked.keys())):
+            picked[track.id] = track
+
+    random_tracks = list(picked.values())
+    random.shuffle(random_tracks)
+    return random_tracks
+
+
+def search_tracks(queryset, keyword):
+    """
+    Tracks of queryset whose title, artist or description contain keyword, most similar first.
+    Each ILIKE is answered by the pg_trgm GIN index of its column, keywords under 3 characters scan
+
+    :return: queryset annotated with rank
+    """
+    match = Q()
+    for field in SEARCH_FIELDS:
+        match |= Q(**{field + '__icontains': keyword})
+    return queryset.filter(match).annotate(rank=Greatest(
+        TrigramSimilarity('title', keyword),
+        TrigramSimilarity('artist', keyword),
+        TrigramSimilarity('description', keyword) * SEARCH_DESCRIPTION_WEIGHT,
+    )).order_by('-rank', '-uploaded_at', '-id')
+
+
+def get_random_track(channel, samples):
+    from .models import (
+        Track, get_channel_filter
+    )
+    from .index import (
+        is_eligible_index_ready, pick_eligible_track_ids, pick_harmonic_track_ids
+    )
 
     # According to International Radio Law, Once played track cannot restream in 3 hours
     now = datetime.now(tz=tzlocal())
-    delta_3hour = timedelta(hours=3)
-    delta_10minute = timedelta(minutes=10)
-    base_time = now - delta_3hour
-    after_10minute = now - delta_10minute
+    base_time = now - LOCKOUT_PLAYED
+    after_10minute = now - LOCKOUT_UPLOADED
 
-    filter_channel = Q(channel__icontains=channel)
+    filter_channel = get_channel_filter(channel)
     filter_track = Q(last_played_at__lt=base_time)
     filter_track_not_play = Q(last_played_at__isnull=True, uploaded_at__lt=after_10minute)
     queryset = Track.objects.filter(filter_channel).filter(filter_track | filter_track_not_play)
 
-    # Remove last played track from queue
-    now_play_track_id = None
-    playlist = None
-    try:
-        redis_data = get_redis_data(channel)
-        now_playing = redis_data["now_playing"]
-        playlist = redis_data["playlist"]
-    except IndexError:
-        pass
-    else:
-        try:
-            if now_playing:
-                now_play_track_id = now_playing["id"]
-        except KeyError:
-            pass
+    # Except now playing and queued tracks, last one is what the next track follows
+    queued_ids = get_queued_track_ids(channel)
+    # Exclusion set is applied once as a single predicate
+    exclude_ids = list(set(queued_ids) | set(get_pending_remove_ids()))
+
+    random_tracks = []
+    if is_eligible_index_ready(channel):
+        track_ids = []
+        # Next track is mixed after the last queued one, or now playing if the queue is empty
+        previous_track_id = queued_ids[-1] if queued_ids else None
+        if get_selection_mode(channel) == SELECTION_MODE_HARMONIC and previous_track_id is not None:
+            track_ids = pick_harmonic_track_ids(channel, previous_track_id, samples, exclude_ids)
+        if len(track_ids) < samples:
+            track_ids += pick_eligible_track_ids(channel, samples - len(track_ids), exclude_ids + track_ids)
+
+        tracks = Track.objects.only(*PLAYLIST_FIELDS).in_bulk(track_ids)
+        random_tracks = [tracks[track_id] for track_id in track_ids if track_id in tracks]
+        if get_selection_mode(channel) != SELECTION_MODE_HARMONIC:
+            random.shuffle(random_tracks)
+
+    if not random_tracks:
+        # No index, or one missing tracks it was not told about, the table is sampled under the same exclusions
+        random_tracks = sample_tracks(queryset, samples, exclude_ids=exclude_ids)
 
-    # Except now playing
-    if now_play_track_id is not None:
-        queryset = queryset.filter(~Q(id=now_play_track_id))
+    return random_tracks
 
-    # Except last play
-    if playlist is not None:
-        for track in playlist:
-            queryset = queryset.filter(~Q(id=track["id"]))
 
-    if queryset.count() < 1:
-        # If service music is too few, ignore International Radio Law.
-        queryset = Track.objects.filter(filter_channel)
+def get_playlist_entry(track):
+    return {
+        "id": int(track.id),
+        "location": "/srv/media/%s" % track.location,
+        "artist": track.artist,
+        "title": track.title
+    }
 
-    count_track = queryset.count()
-    if count_track > samples:
-        count_track = samples
-    random_tracks = random.sample(list(queryset), count_track)
 
-    return random_tracks
+def get_queued_track_ids(channel):
+    """
+    :return: list of track id of now playing followed by the playlist in play order
+    """
+    redis_data = get_redis_data(channel)
+    if not redis_data:
+        return []
+
+    queued_ids = []
+    now_playing = redis_data["now_playing"]
+    if now_playing and now_playing.get("id") is not None:
+        queued_ids.append(int(now_playing["id"]))
+    for track in redis_data["playlist"] or []:
+        queued_ids.append(int(track["id"]))
+    return queued_ids
+
+
+def get_spare_track(channel):
+    """
+    Pop a spare candidate kept by a previous pick.
+    A spare which got queued, played or reserved pending remove meanwhile is dropped.
+    Without the eligible index a recent play can not be told, so spares are not used
+
+    :return: playlist entry dict or None
+    """
+    from .index import (
+        is_eligible_index_ready, is_track_eligible
+    )
 
+    key = SPARE_KEY.format(channel)
+    if not is_eligible_index_ready(channel):
+        redis_server.delete(key)
+        return None
 
-def delete_track(track, force=False):
-    # Remove from playlist
-    channel_list = track.channel
-    location = track.location
-    for channel in channel_list:
+    exclude_ids = None
+    while True:
+        raw_json = redis_server.lpop(key)
+        if raw_json is None:
+            return None
+        spare = json.loads(raw_json)
+
+        if exclude_ids is None:
+            exclude_ids = set(get_queued_track_ids(channel)) | set(get_pending_remove_ids())
+        if spare["id"] in exclude_ids:
+            continue
+        if not is_track_eligible(channel, spare["id"]):
+            continue
+        return spare
+
+
+def set_spare_tracks(channel, spares):
+    key = SPARE_KEY.format(channel)
+    pipe = redis_server.pipeline(transaction=True)
+    pipe.delete(key)
+    if spares:
+        pipe.rpush(key, *[json.dumps(spare, ensure_ascii=False).encode('utf-8') for spare in spares])
+        pipe.expire(key, SPARE_TTL)
+    pipe.execute()
+
+
+def clear_spare_tracks(channels):
+    redis_server.delete(*[SPARE_KEY.format(channel) for channel in channels])
+
+
+def get_now_playing_ids(channels):
+    """
+    :return: set of track id playing now on channels
+    """
+    playing_ids = set()
+    for channel in channels:
         redis_data = get_redis_data(channel)
-        if redis_data:
-            if redis_data["now_playing"]:
-                now_playing = redis_data["now_playing"]
-
-                if int(now_playing["id"]) == track.id:
-                    if not force:
-                        pending_remove = get_pending_remove()
-                        pending_remove_list = pending_remove["list"]
-                        if not get_is_pending_remove(track.id):
-                            if pending_remove_list is None:
-                                pending_remove_list = [track.id]
-                            else:
-                                pending_remove_list.append(track.id)
-                            set_pending_remove(pending_remove_list)
-                            raise ValidationError(_(
-                                "Pending remove reserved for '{0} - {1}' beacuse current playing".format(
-                                    track.artist, track.title
-                                )
-                            ))
-                        else:
-                            raise ValidationError(_("Already pending remove reserved"))
-
-            if redis_data["playlist"]:
-                playlist = redis_data["playlist"]
-
-                for music in playlist:
-                    if int(music["id"]) == track.id:
-                        index = playlist.index(music)
-                        playlist.pop(index)
-
-                set_redis_data(channel, "playlist", playlist)
+        if redis_data and redis_data["now_playing"] and redis_data["now_playing"].get("id") is not None:
+            playing_ids.add(int(redis_data["now_playing"]["id"]))
+    return playing_ids
 
-    try:
-        location_split = location.split("/")
 
-        storage_driver = 'gcs'
-        storage.delete_file('music', location_split[-1], storage_driver)
-    except NotFound:
-        pass
+def soft_delete_tracks(tracks):
+    """
+    Hide tracks from every listing and pick at once.
+    purge_tracks removes their file, playlist entries and row in the background
+    """
+    from .models import (
+        Track
+    )
+    from .index import unindex_track
+
+    tracks = list(tracks)
+    if not tracks:
+        return
+    track_ids = [track.id for track in tracks]
+    Track.all_objects.filter(id__in=track_ids).update(deleted_at=datetime.now(tz=tzlocal()))
+    clear_spare_tracks(set(channel for track in tracks for channel in track.channel))
+
+    def unindex():
+        pipe = redis_server.pipeline(transaction=False)
+        for track_id in track_ids:
+            unindex_track(track_id, pipe)
+        bump_catalogue_generation(pipe)
+        pipe.execute()
+
+    # update() sends no post_delete
+    transaction.on_commit(unindex)
+
+
+def delete_track(track, force=False):
+    """
+    Soft delete track. A track playing now is reserved pending remove instead, unless force
+
+    :raise ValidationError: track was reserved pending remove
+    """
+    if not force and track.id in get_now_playing_ids(track.channel):
+        if add_pending_remove(track.id):
+            raise ValidationError(_(
+                "Pending remove reserved for '{0} - {1}' beacuse current playing".format(
+                    track.artist, track.title
+                )
+            ))
+        else:
+            raise ValidationError(_("Already pending remove reserved"))
 
-    track.delete()
+    soft_delete_tracks([track])
@@ -1,13 +1,16 @@
 import json
+import hashlib
+from django.core import signing
 from django.core.cache import cache
-from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.decorators import method_decorator
+from django.utils.dateparse import parse_datetime
+from django.utils.http import quote_etag, parse_etags
 from django.utils.datastructures import MultiValueDictKeyError
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.decorators.cache import never_cache
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Q, F
 from django.utils.translation import ugettext_lazy as _
 from rest_framework import mixins, generics
 from rest_framework.exceptions import ValidationError
@@ -25,12 +28,175 @@ from .models import (
 )
 from .serializers import (
     TrackSerializer, TrackAPISerializer, LikeSerializer, LikeAPISerializer,
-    PlayQueueSerializer, PlayHistorySerializer
+    PlayQueueSerializer, track_values_serializer
 )
 from .util import (
-    now, get_random_track, get_redis_data, set_redis_data, delete_track, remove_pending_track, get_is_pending_remove,
-    NUM_SAMPLES
+    now, get_random_track, get_playlist_snapshot, delete_track, search_tracks,
+    get_is_pending_remove, are_pending_remove,
+    get_playlist_entry, get_spare_track, set_spare_tracks,
+    play_playlist_head, replace_playlist, append_playlist, insert_playlist, move_playlist, remove_playlist,
+    NUM_SAMPLES, NUM_SPARES
 )
+from .index import mark_track_played
+from .history import buffer_play_on_commit, get_buffered_plays
+from .metrics import get_metrics
+from .export import (
+    parse_export_date, filter_tracks, filter_play_history, stream_export,
+    TRACK_EXPORT_FIELDS, PLAY_HISTORY_EXPORT_FIELDS, EXPORT_FORMATS, EXPORT_NDJSON
+)
+from .track_list_cache import get_cached_track_list, get_track_list_cache_stats
+from .channel_cache import get_cached_redis_data, get_cached_channel_version
+from .daemon import send_setlist, send_delta, get_outbox_stats, PLAYLIST_VERSION_HEADER
+
+
+TRACK_CURSOR_SALT = "radio.track_list.cursor"
+
+
+def get_channel_etag(version, *parts):
+    # ETags are compared per URL, so the channel itself does not need to be part of it
+    return quote_etag("-".join([str(part) for part in parts] + [str(version)]))
+
+
+def is_not_modified(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags
+
+
+def response_not_modified(etag):
+    response = api.response_json_payload(None, status.HTTP_304_NOT_MODIFIED)
+    response['ETag'] = etag
+    return response
+
+
+def encode_track_cursor(uploaded_at, track_id):
+    return signing.dumps([uploaded_at.isoformat(), track_id], salt=TRACK_CURSOR_SALT, compress=True)
+
+
+def decode_track_cursor(cursor):
+    """
+    :return: (uploaded_at, id) of the last track of the previous page
+    :raise ValidationError: cursor was not issued by encode_track_cursor
+    """
+    try:
+        uploaded_at, track_id = signing.loads(cursor, salt=TRACK_CURSOR_SALT)
+        return parse_datetime(uploaded_at), int(track_id)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise ValidationError(_("Invalid cursor"))
+
+
+def encode_search_cursor(offset):
+    return signing.dumps({"offset": offset}, salt=TRACK_CURSOR_SALT)
+
+
+def decode_search_cursor(cursor):
+    """
+    Ranked search results are not ordered by (uploaded_at, id), their cursor holds the offset
+
+    :raise ValidationError: cursor was not issued by encode_search_cursor
+    """
+    try:
+        return max(int(signing.loads(cursor, salt=TRACK_CURSOR_SALT)["offset"]), 0)
+    except (signing.BadSignature, TypeError, ValueError, KeyError):
+        raise ValidationError(_("Invalid cursor"))
+
+
+def get_tracks_after(queryset, cursor):
+    """
+    Keyset page of queryset after cursor in (uploaded_at, id) descending order.
+    The uploaded_at bound lets the composite index start at the cursor instead of skipping rows
+    """
+    uploaded_at, track_id = decode_track_cursor(cursor)
+    return queryset.filter(
+        Q(uploaded_at__lte=uploaded_at) & (Q(uploaded_at__lt=uploaded_at) | Q(id__lt=track_id))
+    )
+
+
+def get_export_filters(request):
+    """
+    :return: (keyword arguments of filter_tracks and filter_play_history, export format)
+    :raise ValidationError:
+    """
+    export_format = request.GET.get("format") or EXPORT_NDJSON
+    if export_format not in EXPORT_FORMATS:
+        raise ValidationError(_("Invalid format"))
+
+    channel = request.GET.get("channel") or None
+    if channel is not None and channel not in dict(CHANNEL):
+        raise ValidationError(_("Invalid channel"))
+
+    try:
+        uploader = int(request.GET["uploader"]) if request.GET.get("uploader") else None
+    except ValueError:
+        raise ValidationError(_("Invalid uploader"))
+
+    try:
+        date_from = parse_export_date(request.GET["date_from"]) if request.GET.get("date_from") else None
+        date_to = parse_export_date(request.GET["date_to"]) if request.GET.get("date_to") else None
+    except ValueError:
+        raise ValidationError(_("Invalid date"))
+
+    return {
+        "channel": channel,
+        "date_from": date_from,
+        "date_to": date_to,
+        "uploader": uploader,
+    }, export_format
+
+
+def response_export(rows, fields, export_format, filename):
+    response = StreamingHttpResponse(
+        stream_export(rows, fields, export_format), content_type=EXPORT_FORMATS[export_format]
+    )
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (filename, export_format)
+    return response
+
+
+# Query parameters of every export view, read by get_export_filters
+EXPORT_MANUAL_PARAMETERS = [
+    openapi.Parameter(
+        name="format",
+        in_=openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        required=False,
+        description="ndjson or csv",
+        default="ndjson"
+    ),
+    openapi.Parameter(
+        name="channel",
+        in_=openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        required=False,
+        description="Channel",
+        default=None
+    ),
+    openapi.Parameter(
+        name="date_from",
+        in_=openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        required=False,
+        description="ISO 8601 date or datetime, inclusive",
+        default=None
+    ),
+    openapi.Parameter(
+        name="date_to",
+        in_=openapi.IN_QUERY,
+        type=openapi.TYPE_STRING,
+        required=False,
+        description="ISO 8601 date or datetime, exclusive",
+        default=None
+    ),
+    openapi.Parameter(
+        name="uploader",
+        in_=openapi.IN_QUERY,
+        type=openapi.TYPE_INTEGER,
+        required=False,
+        description="User id of the uploader",
+        default=None
+    ),
+]
 
 
 @never_cache
@@ -62,12 +228,21 @@ class TrackListAPI(RetrieveAPIView):
             description="Keyword",
             default=None
         ),
+        openapi.Parameter(
+            name="cursor",
+            in_=openapi.IN_QUERY,
+            type=openapi.TYPE_STRING,
+            required=False,
+            description="Next page token of the previous page, empty for the first page. "
+                        "The payload becomes {tracks, next_cursor}",
+            default=None
+        ),
         openapi.Parameter(
             name="page",
             in_=openapi.IN_QUERY,
             type=openapi.TYPE_INTEGER,
-            required=True,
-            description="Page number",
+            required=False,
+            description="Page number, when no cursor is given",
             default=0
         ),
         openapi.Parameter(
@@ -85,7 +260,8 @@ class TrackListAPI(RetrieveAPIView):
 
     @swagger_auto_schema(
         operation_summary="Search Music List",
-        operation_description="Public API. Search music. if keyword is black or null, search entire music list",
+        operation_description="Public API. Search service music by title, artist and description, most relevant "
+                              "first. if keyword is black or null, list entire service music, newest first",
         manual_parameters=manual_parameters,
         responses={'200': TrackSerializer})
     @transaction.atomic
@@ -96,6 +272,11 @@ class TrackListAPI(RetrieveAPIView):
         except MultiValueDictKeyError:
             keyword = None
 
+        try:
+            cursor = request.GET["cursor"]
+        except MultiValueDictKeyError:
+            cursor = None
+
         try:
             page = int(request.GET["page"])
         except MultiValueDictKeyError:
@@ -106,25 +287,48 @@ class TrackListAPI(RetrieveAPIView):
         except MultiValueDictKeyError:
             limit = 30
 
-        if keyword is None:
-            queryset = Track.objects.filter(Q(is_service=True))
+        # The page is ignored when a cursor is given
+        params = {"keyword": keyword or None, "cursor": cursor, "page": page if cursor is None else 0, "limit": limit}
+        if request.user.is_authenticated:
+            response = self.get_page(**params)
         else:
-            queryset = Track.objects.filter(
-                Q(is_service=True) | Q(title__icontains=keyword) | Q(artist__icontains=keyword)
-            )
-
-        track_list = queryset.order_by('-uploaded_at').distinct()[(page * limit):((page * limit) + limit)]
-        response = []
-
-        for track in track_list:
-            is_pending_remove = get_is_pending_remove(track.id)
-            if is_pending_remove:
-                continue
-            serializer = TrackSerializer(track)
-            response.append(serializer.data)
-
+            response = get_cached_track_list(params, lambda: self.get_page(**params))
         return api.response_json(response, status.HTTP_200_OK)
 
+    def get_page(self, keyword, cursor, page, limit):
+        queryset = Track.objects.filter(Q(is_service=True))
+        rows = track_values_serializer.values(queryset)
+        next_cursor = None
+        if keyword:
+            # Ranked, only service tracks are ever searched
+            rows = track_values_serializer.values(search_tracks(queryset, keyword))
+            offset = page * limit if cursor is None else (decode_search_cursor(cursor) if cursor else 0)
+            track_list = list(rows[offset:offset + limit])
+            if track_list and len(track_list) == limit:
+                next_cursor = encode_search_cursor(offset + limit)
+        else:
+            # Rows are unique without DISTINCT, id breaks uploaded_at ties so pages never overlap
+            rows = rows.order_by('-uploaded_at', '-id')
+            if cursor is None:
+                track_list = list(rows[(page * limit):((page * limit) + limit)])
+            elif cursor:
+                track_list = list(get_tracks_after(rows, cursor)[:limit])
+            else:
+                track_list = list(rows[:limit])
+            if track_list and len(track_list) == limit:
+                next_cursor = encode_track_cursor(track_list[-1]["uploaded_at"], track_list[-1]["id"])
+        pending_remove_ids = are_pending_remove([track["id"] for track in track_list])
+        response = track_values_serializer.to_representation(
+            [track for track in track_list if track["id"] not in pending_remove_ids]
+        )
+
+        if cursor is not None:
+            response = {
+                "tracks": response,
+                "next_cursor": next_cursor,
+            }
+        return response
+
 
 class MyTrackAPI(
     mixins.ListModelMixin,
@@ -142,20 +346,54 @@ class MyTrackAPI(
     @method_decorator(ensure_csrf_cookie)
     @method_permission_classes((AllowAny,))
     def get(self, request, *args, **kwargs):
-        tracks = Track.objects.filter(user__id=request.user.id)
+        tracks = list(track_values_serializer.values(Track.objects.filter(user__id=request.user.id)))
+        pending_remove_ids = are_pending_remove([track["id"] for track in tracks])
 
         response = []
-        for track in tracks:
-            serializer = self.serializer_class(track)
-            data = serializer.data
-            is_pending_remove = get_is_pending_remove(track.id)
-            if not is_pending_remove:
+        for data in track_values_serializer.to_representation(tracks):
+            if data["id"] not in pending_remove_ids:
                 response.append(data)
-            response.append(data)
 
         return api.response_json(response, status.HTTP_200_OK)
 
 
+class TrackExportAPI(RetrieveAPIView):
+    manual_parameters = EXPORT_MANUAL_PARAMETERS
+    permission_classes = (IsAuthenticated,)
+    serializer_class = Serializer
+
+    @swagger_auto_schema(
+        operation_summary="Export music list",
+        operation_description="Authentication required. Stream the music list as NDJSON or CSV, "
+                              "only my own music unless admin. Filtered by channel, upload date and uploader",
+        manual_parameters=EXPORT_MANUAL_PARAMETERS,
+        responses={'200': Serializer})
+    def get(self, request, *args, **kwargs):
+        # Not atomic, the rows are read while the response streams after the view returned
+        filters, export_format = get_export_filters(request)
+        if not request.user.is_staff:
+            filters["uploader"] = request.user.id
+        return response_export(filter_tracks(**filters), TRACK_EXPORT_FIELDS, export_format, "tracks")
+
+
+class PlayHistoryExportAPI(RetrieveAPIView):
+    manual_parameters = EXPORT_MANUAL_PARAMETERS
+    permission_classes = (IsAdminUser,)
+    serializer_class = Serializer
+
+    @swagger_auto_schema(
+        operation_summary="Export play history",
+        operation_description="Admin Only API. Stream the play history as NDJSON or CSV. "
+                              "Filtered by channel, play date and uploader of the track",
+        manual_parameters=EXPORT_MANUAL_PARAMETERS,
+        responses={'200': Serializer})
+    def get(self, request, *args, **kwargs):
+        filters, export_format = get_export_filters(request)
+        return response_export(
+            filter_play_history(**filters), PLAY_HISTORY_EXPORT_FIELDS, export_format, "play_history"
+        )
+
+
 class TrackAPI(
     mixins.ListModelMixin,
     mixins.UpdateModelMixin,
@@ -175,7 +413,7 @@ class TrackAPI(
     @method_permission_classes((AllowAny,))
     def get(self, request, track_id, *args, **kwargs):
         try:
-            track = Track.objects.get(id=track_id)
+            track = Track.objects.select_related('user__profile').get(id=track_id)
         except Track.DoesNotExist:
             raise ValidationError(_("Music does not exist"))
 
@@ -305,7 +543,7 @@ class PlayQueueAPI(RetrieveAPIView):
             name="page",
             in_=openapi.IN_QUERY,
             type=openapi.TYPE_INTEGER,
-            required=True,
+            required=False,
             description="Page number",
             default=0
         ),
@@ -348,15 +586,20 @@ class PlayQueueAPI(RetrieveAPIView):
         except MultiValueDictKeyError:
             limit = 30
 
-        redis_data = get_redis_data(channel)
-        if redis_data:
-            playlist = redis_data["playlist"]
-            if playlist:
-                return api.response_json(playlist[(page * limit):((page * limit) + limit)], status.HTTP_200_OK)
-            else:
-                return api.response_json(None, status.HTTP_200_OK)
+        etag = get_channel_etag(get_cached_channel_version(channel), "playqueue", page, limit)
+        if is_not_modified(request, etag):
+            return response_not_modified(etag)
 
-        return api.response_json(None, status.HTTP_200_OK)
+        redis_data = get_cached_redis_data(channel)
+        etag = get_channel_etag(redis_data["version"], "playqueue", page, limit)
+
+        playlist = redis_data["playlist"]
+        if playlist:
+            response = api.response_json(playlist[(page * limit):((page * limit) + limit)], status.HTTP_200_OK)
+        else:
+            response = api.response_json(None, status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
 
 
 class ChannelNameAPI(RetrieveAPIView):
@@ -375,7 +618,14 @@ class ChannelNameAPI(RetrieveAPIView):
             if in_service_channel == channel:
                 channel_name = in_service_channel_name
 
-        return api.response_json(channel_name, status.HTTP_200_OK)
+        # Channel names only change with a deploy, so the name itself is the version
+        etag = quote_etag(hashlib.md5(json.dumps(channel_name).encode('utf-8')).hexdigest())
+        if is_not_modified(request, etag):
+            return response_not_modified(etag)
+
+        response = api.response_json(channel_name, status.HTTP_200_OK)
+        response['ETag'] = etag
+        return response
 
 
 class NowPlayingAPI(RetrieveAPIView):
@@ -389,12 +639,18 @@ class NowPlayingAPI(RetrieveAPIView):
     @transaction.atomic
     @method_decorator(ensure_csrf_cookie)
     def get(self, request, channel, *args, **kwargs):
-        redis_data = get_redis_data(channel)
-        if redis_data:
-            now_playing = redis_data["now_playing"]
-            return api.response_json(now_playing, status.HTTP_200_OK)
+        if channel not in SERVICE_CHANNEL:
+            raise ValidationError(_("Invalid service channel"))
+
+        etag = get_channel_etag(get_cached_channel_version(channel), "nowplaying")
+        if is_not_modified(request, etag):
+            return response_not_modified(etag)
+
+        redis_data = get_cached_redis_data(channel)
 
-        return api.response_json(None, status.HTTP_200_OK)
+        response = api.response_json(redis_data["now_playing"], status.HTTP_200_OK)
+        response['ETag'] = get_channel_etag(redis_data["version"], "nowplaying")
+        return response
 
 
 class PlayQueueResetAPI(RetrieveAPIView):
@@ -412,6 +668,7 @@ class PlayQueueResetAPI(RetrieveAPIView):
             raise ValidationError(_("Invalid service channel"))
 
         random_tracks = get_random_track(channel, NUM_SAMPLES)
+        pending_remove_ids = are_pending_remove([track.id for track in random_tracks])
 
         response_daemon_data = []
         for track in random_tracks:
@@ -419,8 +676,7 @@ class PlayQueueResetAPI(RetrieveAPIView):
             artist = track.artist
             title = track.title
 
-            is_pending_remove = get_is_pending_remove(track.id)
-            if is_pending_remove:
+            if track.id in pending_remove_ids:
                 continue
             else:
                 response_daemon_data.append({
@@ -430,14 +686,8 @@ class PlayQueueResetAPI(RetrieveAPIView):
                     "title": title
                 })
 
-        response_daemon = {
-            "host": "server",
-            "target": channel,
-            "command": "setlist",
-            "data": response_daemon_data
-        }
-
-        api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data=response_daemon)
+        version, playlist = replace_playlist(channel, response_daemon_data)
+        response_daemon = send_setlist(channel, version, playlist)
 
         return api.response_json(response_daemon, status.HTTP_202_ACCEPTED)
 
@@ -465,25 +715,13 @@ class QueueINAPI(RetrieveAPIView):
         if is_pending_remove:
             raise ValidationError(_("You cannot queue-in because the track is reserved pending remove"))
 
-        redis_data = get_redis_data(channel)
-        playlist = redis_data["playlist"]
+        entry = get_playlist_entry(track)
+        try:
+            version, playlist = insert_playlist(channel, int(index), entry)
+        except IndexError:
+            raise ValidationError(_("Invalid playlist index"))
 
-        new_track = {
-            "id": track.id,
-            "location": "/srv/media/%s" % track.location,
-            "artist": track.artist,
-            "title": track.title
-        }
-
-        playlist.insert(int(index), new_track)
-        set_redis_data(channel, "playlist", playlist)
-
-        api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data={
-            "host": "server",
-            "target": channel,
-            "command": "setlist",
-            "data": playlist
-        })
+        send_delta(channel, version, {"op": "insert", "index": int(index), "entry": entry})
 
         return api.response_json("OK", status.HTTP_201_CREATED)
 
@@ -502,18 +740,12 @@ class QueueMoveAPI(RetrieveAPIView):
         if channel not in SERVICE_CHANNEL:
             raise ValidationError(_("Invalid service channel"))
 
-        redis_data = get_redis_data(channel)
-        playlist = redis_data["playlist"]
+        try:
+            version, playlist = move_playlist(channel, from_index, to_index)
+        except IndexError:
+            raise ValidationError(_("Invalid playlist index"))
 
-        playlist.insert(to_index, playlist.pop(from_index))
-        set_redis_data(channel, "playlist", playlist)
-
-        api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data={
-            "host": "server",
-            "target": channel,
-            "command": "setlist",
-            "data": playlist
-        })
+        send_delta(channel, version, {"op": "move", "from": from_index, "to": to_index})
 
         return api.response_json("OK", status.HTTP_201_CREATED)
 
@@ -532,20 +764,12 @@ class QueueOUTAPI(DestroyAPIView):
         if channel not in SERVICE_CHANNEL:
             raise ValidationError(_("Invalid service channel"))
 
-        redis_data = get_redis_data(channel)
-        playlist = redis_data["playlist"]
-
-        playlist.pop(index)
-        set_redis_data(channel, "playlist", playlist)
+        try:
+            version, playlist = remove_playlist(channel, index)
+        except IndexError:
+            raise ValidationError(_("Invalid playlist index"))
 
-        api.request_async_threaded("POST", settings.MUSICDAEMON_URL, callback=None, data={
-            "host": "server",
-            "target": channel,
-            "command": "unqueue",
-            "data": {
-                "index_at": index
-            }
-        })
+        send_delta(channel, version, {"op": "remove", "index": index})
 
         return api.response_json("OK", status.HTTP_202_ACCEPTED)
 
@@ -564,28 +788,25 @@ class CallbackOnStartupAPI(RetrieveAPIView):
         if channel not in SERVICE_CHANNEL:
             raise ValidationError(_("Invalid service channel"))
 
-        redis_data = get_redis_data(channel)
+        version, playlist = get_playlist_snapshot(channel)
 
         response = []
-        if redis_data and redis_data["playlist"]:
+        if playlist:
             # Use pre exist queue
-            response = redis_data["playlist"]
+            response = playlist
         else:
             # Select random track except for last played in 3 hours
             queue_tracks = get_random_track(channel, NUM_SAMPLES)
 
             # Set playlist
             for track in queue_tracks:
-                response.append({
-                    "id": int(track.id),
-                    "location": "/srv/media/%s" % track.location,
-                    "artist": track.artist,
-                    "title": track.title
-                })
+                response.append(get_playlist_entry(track))
 
-            set_redis_data(channel, "playlist", response)
+            version, response = replace_playlist(channel, response)
 
-        return api.response_json_payload(response, status.HTTP_200_OK)
+        response = api.response_json_payload(response, status.HTTP_200_OK)
+        response[PLAYLIST_VERSION_HEADER] = str(version)
+        return response
 
 
 class CallbackOnPlayAPI(CreateAPIView):
@@ -603,26 +824,38 @@ class CallbackOnPlayAPI(CreateAPIView):
         if channel not in SERVICE_CHANNEL:
             raise ValidationError(_("Invalid service channel"))
 
-        try:
-            track = Track.objects.get(id=request.data["id"])
-        except Track.DoesNotExist:
+        entry = PlayQueueSerializer(data=request.data)
+        entry.is_valid(raise_exception=True)
+        track_id = entry.validated_data["id"]
+        played_at = now()
+
+        # Single UPDATE, concurrent plays of the same track on other channels all count.
+        # A track soft deleted while queued is still played until purged, and must still trim the head
+        if not Track.all_objects.filter(id=track_id).update(play_count=F('play_count') + 1, last_played_at=played_at):
             raise ValidationError(_("Music does not exist"))
 
-        history = PlayHistorySerializer(data={
-            "track_id": request.data["id"],
-            "artist": request.data["artist"],
-            "title": request.data["title"],
-            "channel": channel,
-            "played_at": now()
+        # Buffered for flush_play_history once committed, a rolled back play leaves no history
+        artist, title = entry.validated_data["artist"], entry.validated_data["title"]
+        transaction.on_commit(lambda: buffer_play_on_commit(track_id, artist, title, channel, played_at))
+        # update() sends no post_save, so the eligible index is told directly
+        transaction.on_commit(lambda: mark_track_played(track_id, played_at))
+
+        # Publishes the change so now playing caches do not wait for their TTL
+        version, played = play_playlist_head(channel, {
+            "id": track_id,
+            "location": entry.validated_data["location"],
+            "artist": entry.validated_data["artist"],
+            "title": entry.validated_data["title"]
         })
-        history.is_valid(raise_exception=True)
-        history.save()
 
-        track.last_played_at = now()
-        track.play_count += 1
-        track.save()
-
-        return api.response_json("OK", status.HTTP_200_OK)
+        response = api.response_json("OK", status.HTTP_200_OK)
+        if played == 1:
+            # The daemon took the same head off its queue, this is its playlist version now
+            response[PLAYLIST_VERSION_HEADER] = str(version)
+        elif played > 1:
+            # Entries before the played one were skipped by the daemon, which is resynced
+            transaction.on_commit(lambda: send_setlist(channel, *get_playlist_snapshot(channel)))
+        return response
 
 
 class CallbackOnStopAPI(CreateAPIView):
@@ -640,26 +873,41 @@ class CallbackOnStopAPI(CreateAPIView):
         if channel not in SERVICE_CHANNEL:
             raise ValidationError(_("Invalid service channel"))
 
-        remove_pending_track()
-
-        random_tracks = get_random_track(channel, 1)
+        new_track = get_spare_track(channel)
+        if new_track is None:
+            # Fetch spares in the same round-trip so the next on_stop usually needs no query
+            random_tracks = get_random_track(channel, 1 + NUM_SPARES)
+            if random_tracks:
+                new_track = get_playlist_entry(random_tracks[0])
+                set_spare_tracks(channel, [get_playlist_entry(track) for track in random_tracks[1:]])
 
-        if random_tracks:
+        if new_track is not None:
             # Add next track to queue at last
-            next_track = random_tracks[0]
-
-            new_track = {
-                "id": int(next_track.id),
-                "location": "/srv/media/%s" % next_track.location,
-                "artist": next_track.artist,
-                "title": next_track.title
-            }
+            version, playlist = append_playlist(channel, new_track)
 
-            redis_data = get_redis_data(channel)
-            playlist = redis_data["playlist"]
-            playlist.append(new_track)
-            set_redis_data(channel, "playlist", playlist)
-
-            return api.response_json_payload(new_track, status.HTTP_200_OK)
+            response = api.response_json_payload(new_track, status.HTTP_200_OK)
+            # Skipped if the track got queued meanwhile, the daemon then finds the gap on the next delta
+            if playlist and playlist[-1]["id"] == new_track["id"]:
+                response[PLAYLIST_VERSION_HEADER] = str(version)
+            return response
         else:
             return api.response_json_payload(None, status.HTTP_200_OK)
+
+
+class MetricsAPI(RetrieveAPIView):
+    permission_classes = (IsAdminUser,)
+    renderer_classes = (JSONRenderer,)
+
+    @swagger_auto_schema(
+        operation_summary="Radio Metrics",
+        operation_description="Admin Only API. Counters of the worker which serves the request "
+                              "with the track list cache hit ratio, the daemon outbox of every service channel "
+                              "and the play history buffer",
+        responses={'200': Serializer})
+    def get(self, request, *args, **kwargs):
+        payload = get_metrics()
+        payload["track_list_cache"] = get_track_list_cache_stats(payload)
+        payload["outbox"] = get_outbox_stats(SERVICE_CHANNEL)
+        buffered, waited = get_buffered_plays()
+        payload["play_history"] = {"buffered": buffered, "waited": round(waited, 3)}
+        return api.response_json(payload, status.HTTP_200_OK)
@@ -14,6 +14,8 @@ if [[ ${MIGRATE} == *"1"* ]]; then
   python3 manage.py collectstatic --noinput -i yes
   python3 manage.py makemigrations radio
   python3 manage.py migrate
+  python3 manage.py migrate_redis_state
+  python3 manage.py rebuild_eligible_index
 fi
 
 if [[ ${WAIT_SERVICE} == *"1"* ]]; then
@@ -23,6 +25,22 @@ if [[ ${WAIT_SERVICE} == *"1"* ]]; then
   done
 fi
 
+if [[ ${PUSH_GATEWAY} == *"1"* ]]; then
+  python3 manage.py run_push_gateway --port ${PUSH_GATEWAY_PORT} &
+fi
+
+if [[ ${DAEMON_OUTBOX} == *"1"* ]]; then
+  python3 manage.py run_daemon_outbox &
+fi
+
+if [[ ${PLAY_HISTORY_FLUSH} == *"1"* ]]; then
+  python3 manage.py flush_play_history &
+fi
+
+if [[ ${PURGE_TRACKS} == *"1"* ]]; then
+  python3 manage.py purge_tracks &
+fi
+
 if [[ ${AUTOSTART} == *"1"* ]]; then
   uwsgi --show-config
 fi